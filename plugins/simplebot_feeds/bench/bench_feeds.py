@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Benchmark simplebot_feeds checking cycles against a local fake feed server.
+
+Example: python bench/bench_feeds.py --feeds 2000 --latency 0.2 --workers 16
+
+For every cycle it reports wall time, CPU time of the bot process and of
+its worker processes, peak RSS, requests received by the server and
+messages fanned out to the subscribed chats.
+
+With --websub the feeds advertise a local stand-in hub, the bot subscribes
+to it after the first cycle and, from then on, the hub pushes every feed
+before each cycle instead of the feeds being polled.
+"""
+import argparse
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simplebot_feeds  # noqa
+from fake_hub import FakeHub  # noqa
+from fake_server import add_arguments, from_args  # noqa
+
+
+class StubBot:
+    """The parts of DeltaBot used by the feeds checker."""
+
+    def __init__(self, db_path: str, settings: dict) -> None:
+        self.account = SimpleNamespace(db_path=db_path)
+        self.logger = logging.getLogger('bench')
+        self.settings = settings
+
+    def get(self, key: str, default=None, scope: str = 'global'):
+        return self.settings.get(key, default)
+
+    def set(self, key: str, value, scope: str = 'global') -> None:
+        self.settings[key] = value
+
+    def get_chat(self, gid: int) -> int:
+        return gid
+
+
+class CountingReplies:
+    """Replace Replies to count the messages instead of sending them."""
+    sent = 0
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.messages: list = []
+
+    def add(self, **kwargs) -> None:
+        self.messages.append(kwargs)
+
+    def send_reply_messages(self) -> None:
+        CountingReplies.sent += len(self.messages)
+
+
+def workers_cpu(fetcher: simplebot_feeds.FeedFetcher) -> float:
+    """CPU seconds used so far by the parsing worker processes (Linux only,
+    RUSAGE_CHILDREN doesn't include processes that are still running).
+    """
+    total = 0.0
+    for pid in getattr(fetcher.parser, '_processes', None) or {}:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as fh:
+                fields = fh.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            pass
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(argparser)
+    argparser.add_argument('--cycles', type=int, default=3)
+    argparser.add_argument('--subscribers', type=int, default=1,
+                           help='chats subscribed to every feed')
+    argparser.add_argument('--workers', type=int, default=8)
+    argparser.add_argument('--workers-per-host', type=int, default=2)
+    argparser.add_argument('--parse-processes', type=int, default=0)
+    argparser.add_argument('--host-rate', type=float, default=1,
+                           help='requests per second allowed per host')
+    argparser.add_argument('--host-burst', type=int, default=5)
+    argparser.add_argument('--timeout', type=float, default=30)
+    argparser.add_argument('--scheduled', action='store_true',
+                           help='only check due feeds instead of all of them'
+                           ' every cycle')
+    argparser.add_argument('--websub', action='store_true',
+                           help='push the feeds through a local WebSub hub')
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    settings = {
+        'workers': args.workers,
+        'workers_per_host': args.workers_per_host,
+        'parse_processes': args.parse_processes,
+        'timeout': args.timeout,
+        'host_rate': args.host_rate,
+        'host_burst': args.host_burst,
+        'fanout_batch': 1000,
+    }
+    hub = None
+    if args.websub:
+        hub = FakeHub()
+        threading.Thread(target=hub.serve_forever, daemon=True).start()
+        receiver = simplebot_feeds.WebSubServer(
+            ('127.0.0.1', 0), simplebot_feeds._get_subscription,
+            simplebot_feeds._websub_verified, simplebot_feeds._websub_pushed)
+        threading.Thread(target=receiver.serve_forever, daemon=True).start()
+        settings['websub_port'] = receiver.server_address[1]
+        args.hub = hub.url
+    server = from_args(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_feeds_')
+    bot = StubBot(os.path.join(tmpdir, 'bot.db'), settings)
+    simplebot_feeds.Replies = CountingReplies
+    simplebot_feeds.deltabot_init(bot)
+    db = simplebot_feeds.db
+    feed_urls = server.feed_urls()
+    for n, url in enumerate(feed_urls):
+        db.add_feed(url, None, None, None)
+        for i in range(args.subscribers):
+            db.add_fchat(n * args.subscribers + i, url)
+
+    fetcher = simplebot_feeds.FeedFetcher(
+        workers=args.workers, per_host=args.workers_per_host,
+        timeout=args.timeout, processes=args.parse_processes,
+        host_rate=args.host_rate, host_burst=args.host_burst)
+    print('cycle  feeds    wall     cpu  cpu(children)  rss(MB)  requests'
+          '    304  errors  messages  pushed')
+    for cycle in range(1, args.cycles + 1):
+        if not args.scheduled:
+            db.commit('UPDATE feeds SET next_check=0')
+        due = len(db.get_due_feeds(time.time()))
+        pushed = 0
+        if hub:
+            for topic in hub.topics():
+                pushed += hub.publish(topic)
+        server.reset_stats()
+        CountingReplies.sent = 0
+        start_workers_cpu = workers_cpu(fetcher)
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+
+        simplebot_feeds._check_pushed_feeds(bot)
+        simplebot_feeds._check_due_feeds(bot, fetcher)
+        while simplebot_feeds._send_outbox_batch(bot):
+            pass
+
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - start_cpu
+        children_cpu = workers_cpu(fetcher) - start_workers_cpu
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print('{:>5} {:>6} {:>7.2f} {:>7.2f} {:>14.2f} {:>8.1f} {:>9} {:>6}'
+              ' {:>7} {:>9} {:>7}'.format(
+                  cycle, due, wall, cpu, children_cpu, rss, server.requests,
+                  server.not_modified, server.errors, CountingReplies.sent,
+                  pushed))
+
+        if hub and cycle == 1:
+            simplebot_feeds._renew_websub(bot, fetcher)
+            deadline = time.time() + 30
+            while hub.verified < len(feed_urls) and time.time() < deadline:
+                time.sleep(0.1)
+    fetcher.shutdown()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
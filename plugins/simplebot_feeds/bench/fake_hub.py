@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Local stand-in WebSub hub.
+
+Subscribers are verified and stored in memory. Publishers ping the hub with
+`hub.mode=publish&hub.url=<topic>`, the hub then fetches the topic and
+pushes it, signed with the subscriber's secret, to all the callbacks
+subscribed to it.
+"""
+import argparse
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+from urllib.parse import parse_qs
+
+import requests
+
+
+class FakeHub(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port: int = 0, max_lease: int = 60*60*24) -> None:
+        super().__init__(('127.0.0.1', port), HubHandler)
+        self.max_lease = max_lease
+        # topic -> callback -> (secret, expires)
+        self.subscriptions: Dict[str, Dict[str, Tuple[str, float]]] = {}
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.verified = 0
+        self.pushed = 0
+
+    @property
+    def url(self) -> str:
+        return 'http://{}:{}/'.format(*self.server_address)
+
+    def verify(self, topic: str, callback: str, secret: str,
+               lease: int) -> None:
+        """Confirm the intent of the subscriber, as required by WebSub."""
+        challenge = secrets.token_hex(8)
+        try:
+            resp = self.session.get(callback, timeout=10, params={
+                'hub.mode': 'subscribe', 'hub.topic': topic,
+                'hub.challenge': challenge, 'hub.lease_seconds': lease})
+        except requests.RequestException:
+            return
+        if resp.status_code == 200 and resp.text == challenge:
+            with self.lock:
+                self.subscriptions.setdefault(topic, {})[callback] = (
+                    secret, time.time() + lease)
+                self.verified += 1
+
+    def publish(self, topic: str, body: bytes = None) -> int:
+        """Push the topic content to its subscribers, downloading it if not
+        given. Returns the number of subscribers it was sent to.
+        """
+        now = time.time()
+        with self.lock:
+            subs = [(callback, secret) for callback, (secret, expires)
+                    in self.subscriptions.get(topic, {}).items()
+                    if expires > now]
+        if not subs:
+            return 0
+        if body is None:
+            body = self.session.get(topic, timeout=10).content
+        for callback, secret in subs:
+            signature = hmac.new(
+                secret.encode(), body, hashlib.sha256).hexdigest()
+            try:
+                resp = self.session.post(callback, data=body, timeout=10,
+                                         headers={
+                    'Content-Type': 'application/xml',
+                    'Link': '<{}>; rel="hub", <{}>; rel="self"'.format(
+                        self.url, topic),
+                    'X-Hub-Signature': 'sha256=' + signature})
+            except requests.RequestException:
+                continue
+            if resp.status_code == 410:
+                with self.lock:
+                    self.subscriptions[topic].pop(callback, None)
+        with self.lock:
+            self.pushed += len(subs)
+        return len(subs)
+
+    def topics(self) -> list:
+        with self.lock:
+            return list(self.subscriptions)
+
+
+class HubHandler(BaseHTTPRequestHandler):
+    server: FakeHub
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self) -> None:
+        size = int(self.headers.get('Content-Length') or 0)
+        form = {k: v[0] for k, v in parse_qs(
+            self.rfile.read(size).decode()).items()}
+        mode = form.get('hub.mode')
+        if mode == 'subscribe' and form.get('hub.callback') and form.get(
+                'hub.topic'):
+            lease = min(int(form.get('hub.lease_seconds') or 0) or
+                        self.server.max_lease, self.server.max_lease)
+            threading.Thread(target=self.server.verify, daemon=True, args=(
+                form['hub.topic'], form['hub.callback'],
+                form.get('hub.secret', ''), lease)).start()
+            self._reply(202)
+        elif mode == 'publish' and form.get('hub.url'):
+            threading.Thread(target=self.server.publish, daemon=True,
+                             args=(form['hub.url'],)).start()
+            self._reply(204)
+        else:
+            self._reply(400)
+
+    def _reply(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--port', type=int, default=8081)
+    argparser.add_argument('--max-lease', type=int, default=60*60*24)
+    cli_args = argparser.parse_args()
+    hub = FakeHub(cli_args.port, cli_args.max_lease)
+    print('Hub listening at', hub.url)
+    hub.serve_forever()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Local HTTP server serving thousands of synthetic RSS/Atom feeds.
+
+Feed `n` is available at `/<n>`, odd feeds are Atom and even feeds RSS.
+Each feed publishes a new entry every `period * (1 + n % 10)` seconds, so
+repeated polls see a realistic mix of changed and unchanged feeds.
+"""
+import argparse
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from xml.sax.saxutils import escape
+
+RSS_ITEM = '''<item><title>{title}</title><link>{link}</link>
+<guid>{link}</guid><pubDate>{date}</pubDate>
+<description>{desc}</description></item>'''
+RSS = '''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel><title>Feed {n}</title><link>{base}</link>
+<description>Synthetic feed {n}</description>
+{items}
+</channel></rss>'''
+ATOM_ENTRY = '''<entry><title>{title}</title><link href="{link}"/>
+<id>{link}</id><updated>{date}</updated>
+<summary type="html">{desc}</summary></entry>'''
+ATOM = '''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>Feed {n}</title>
+<link href="{base}"/><id>{base}</id><updated>{updated}</updated>
+{items}
+</feed>'''
+
+
+class FeedServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port: int = 0, feeds: int = 1000, hosts: int = 50,
+                 entries: int = 20, entry_size: int = 500,
+                 latency: float = 0.0, error_rate: float = 0.0,
+                 etag: bool = True, period: float = 60,
+                 hub: str = None) -> None:
+        # bind to all addresses so feeds can be spread over 127.0.0.0/8
+        # and look like different hosts to the fetcher
+        super().__init__(('0.0.0.0', port), FeedHandler)
+        self.feeds = feeds
+        self.hosts = max(hosts, 1)
+        self.entries = entries
+        self.entry_size = entry_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.etag = etag
+        self.period = period
+        self.hub = hub
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.requests = 0
+            self.not_modified = 0
+            self.errors = 0
+            self.bytes_sent = 0
+
+    def count(self, status: int, size: int) -> None:
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += size
+            if status == 304:
+                self.not_modified += 1
+            elif status >= 400:
+                self.errors += 1
+
+    def feed_urls(self) -> List[str]:
+        port = self.server_address[1]
+        return ['http://127.0.0.{}:{}/{}'.format(1 + n % self.hosts, port, n)
+                for n in range(self.feeds)]
+
+    def latest(self, n: int) -> int:
+        """Index of the newest entry currently published by feed `n`."""
+        return int(time.time() / (self.period * (1 + n % 10)))
+
+    def render(self, n: int, base: str) -> bytes:
+        period = self.period * (1 + n % 10)
+        latest = self.latest(n)
+        atom = n % 2 == 1
+        filler = 'Lorem ipsum dolor sit amet. ' * (self.entry_size // 28 + 1)
+        items = []
+        for i in range(latest, latest - self.entries, -1):
+            date = i * period
+            items.append((ATOM_ENTRY if atom else RSS_ITEM).format(
+                title='Entry {} of feed {}'.format(i, n),
+                link='{}/entry/{}'.format(base, i),
+                date=_atom_date(date) if atom else formatdate(date),
+                desc=escape('<p>{}</p>'.format(filler[:self.entry_size]))))
+        return (ATOM if atom else RSS).format(
+            n=n, base=base, updated=_atom_date(latest * period),
+            items='\n'.join(items)).encode()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    server: FeedServer
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(0, 2 * server.latency))
+        try:
+            n = int(self.path.strip('/'))
+            assert 0 <= n < server.feeds
+        except (ValueError, AssertionError):
+            self._reply(404, b'')
+            return
+        if random.random() < server.error_rate:
+            if random.random() < 0.5:
+                self._reply(500, b'')
+            else:
+                self._reply(200, b'<?xml version="1.0"?><rss><channel><ti',
+                            {'Content-Type': 'application/rss+xml'})
+            return
+
+        headers = {'Content-Type': 'application/xml; charset=utf-8'}
+        base = 'http://{}'.format(self.headers.get('Host', 'localhost'))
+        if server.hub:
+            headers['Link'] = '<{}>; rel="hub", <{}/{}>; rel="self"'.format(
+                server.hub, base, n)
+        if server.etag:
+            etag = '"{}-{}"'.format(n, server.latest(n))
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                self._reply(304, b'', headers)
+                return
+        self._reply(200, server.render(n, base), headers)
+
+    def _reply(self, status: int, body: bytes, headers: dict = None) -> None:
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(status, len(body))
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def _atom_date(timestamp: float) -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--feeds', type=int, default=1000)
+    parser.add_argument('--hosts', type=int, default=50,
+                        help='spread the feeds over this many hostnames')
+    parser.add_argument('--entries', type=int, default=20,
+                        help='entries per feed document')
+    parser.add_argument('--entry-size', type=int, default=500,
+                        help='bytes of description per entry')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='average response latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests that fail')
+    parser.add_argument('--no-etag', dest='etag', action='store_false',
+                        help='never send ETag or reply 304')
+    parser.add_argument('--period', type=float, default=60,
+                        help='base seconds between new entries')
+    parser.add_argument('--hub', help='WebSub hub advertised by the feeds')
+
+
+def from_args(args: argparse.Namespace, port: int = 0) -> FeedServer:
+    return FeedServer(
+        port=port, feeds=args.feeds, hosts=args.hosts, entries=args.entries,
+        entry_size=args.entry_size, latency=args.latency,
+        error_rate=args.error_rate, etag=args.etag, period=args.period,
+        hub=args.hub)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--port', type=int, default=8080)
+    add_arguments(argparser)
+    cli_args = argparser.parse_args()
+    feed_server = from_args(cli_args, cli_args.port)
+    print('Serving {} feeds, e.g. {}'.format(
+        cli_args.feeds, feed_server.feed_urls()[0]))
+    feed_server.serve_forever()
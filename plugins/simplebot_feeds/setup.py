@@ -43,7 +43,8 @@ if __name__ == "__main__":
         install_requires=[
             'simplebot',
             'feedparser',
-            'html2text'
+            'html2text',
+            'requests'
         ],
         entry_points={
             'simplebot.plugins': '{0} = {0}'.format(MODULE_NAME),
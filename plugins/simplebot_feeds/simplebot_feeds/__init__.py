@@ -1,25 +1,35 @@
 
+import io
 import os
 import sqlite3
-from threading import Thread
-from time import sleep
-from typing import Optional
+from queue import Empty, Queue
+from threading import Event, Thread
+from time import gmtime, sleep, strftime, time
+from typing import List, Optional, Set, Tuple
 
 import feedparser
 import html2text
 import simplebot
 from deltachat import Chat, Contact, Message
-from feedparser.exceptions import CharacterEncodingOverride
+from feedparser.util import FeedParserDict
 from simplebot import DeltaBot
 from simplebot.bot import Replies
 
 from .db import DBManager
+from .fetcher import FeedFetcher, Response, fetch, parse, retry_after
+from .parser import FeedError
+from .stats import AVERAGES, FeedStats
+from .websub import WebSubServer, new_token, subscribe
 
 __version__ = '1.0.0'
 feedparser.USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:60.0)'
 feedparser.USER_AGENT += ' Gecko/20100101 Firefox/60.0'
 html2text.config.WRAP_LINKS = False
 db: DBManager
+outbox_event = Event()
+stats = FeedStats()
+websub_queue: Queue = Queue()
+websub_event = Event()
 
 
 @simplebot.hookimpl
@@ -28,12 +38,41 @@ def deltabot_init(bot: DeltaBot) -> None:
     db = _get_db(bot)
 
     _getdefault(bot, 'delay', 60*5)
+    _getdefault(bot, 'min_delay', 60)
+    _getdefault(bot, 'max_delay', 60*60*24)
+    _getdefault(bot, 'seen_retention', 60*60*24*30)
+    _getdefault(bot, 'render_cache_size', 2000)
+    _getdefault(bot, 'max_failures', 10)
+    _getdefault(bot, 'quarantine_delay', 60*60*24*7)
     _getdefault(bot, 'max_feed_count', -1)
+    _getdefault(bot, 'workers', 8)
+    _getdefault(bot, 'workers_per_host', 2)
+    _getdefault(bot, 'host_rate', 1)
+    _getdefault(bot, 'host_burst', 5)
+    _getdefault(bot, 'timeout', 30)
+    _getdefault(bot, 'parse_processes', 0)
+    _getdefault(bot, 'fanout_batch', 20)
+    _getdefault(bot, 'fanout_delay', 2)
+    _getdefault(bot, 'fanout_retries', 5)
+    _getdefault(bot, 'stats_interval', 60*10)
+    _getdefault(bot, 'websub_port', 0)
+    _getdefault(bot, 'websub_host', '0.0.0.0')
+    _getdefault(bot, 'websub_url', '')
+    _getdefault(bot, 'websub_lease', 60*60*24*7)
+    _getdefault(bot, 'websub_retry', 60*60)
+    stats.load(db.get_feed_stats())
 
 
 @simplebot.hookimpl
 def deltabot_start(bot: DeltaBot) -> None:
     Thread(target=_check_feeds, args=(bot,), daemon=True).start()
+    Thread(target=_send_outbox, args=(bot,), daemon=True).start()
+    port = int(_getdefault(bot, 'websub_port'))
+    if port:
+        server = WebSubServer(
+            (_getdefault(bot, 'websub_host'), port), _get_subscription,
+            _websub_verified, _websub_pushed)
+        Thread(target=server.serve_forever, daemon=True).start()
 
 
 @simplebot.hookimpl
@@ -56,26 +95,29 @@ def feed_sub(bot: DeltaBot, payload: str, message: Message, replies: Replies) ->
     feed = db.get_feed(url)
 
     if feed:
-        d = feedparser.parse(feed['url'])
+        d = _parse_url(bot, feed['url'], db.get_rendered_entries(feed['url']))
     else:
         max_fc = int(_getdefault(bot, 'max_feed_count'))
         if 0 <= max_fc <= len(db.get_feeds()):
             replies.add(text='Sorry, maximum number of feeds reached')
             return
-        d = feedparser.parse(url)
-        bozo_exception = d.get('bozo_exception', '')
-        if (d.get('bozo') == 1 and not isinstance(
-                bozo_exception, CharacterEncodingOverride)) or not d.entries:
+        d = _parse_url(bot, url)
+        if d.bozo or not d.entries:
             replies.add(text='Invalid feed url: {}'.format(url))
-            bot.logger.warning('Invalid feed %s: %s', url, bozo_exception)
+            bot.logger.warning(
+                'Invalid feed %s: %s', url, d.get('bozo_exception', ''))
             return
         feed = dict(
             url=url,
             etag=d.get('etag'),
-            modified=d.get('modified') or d.get('updated'),
+            modified=d.get('modified'),
             latest=get_latest_date(d.entries),
         )
-        db.add_feed(url, feed['etag'], feed['modified'], feed['latest'])
+        delay = float(_getdefault(bot, 'delay'))
+        db.add_feed(url, feed['etag'], feed['modified'], feed['latest'],
+                    time() + delay, delay)
+        db.add_seen_entries(url, d.hashes, time())
+        _discover_hub(bot, url, d)
     assert feed
 
     if message.chat.is_group():
@@ -94,9 +136,12 @@ def feed_sub(bot: DeltaBot, payload: str, message: Message, replies: Replies) ->
     text = 'Title: {}\n\nURL: {}\n\nDescription: {}'.format(
         title, feed['url'], desc)
 
-    if d.entries and feed['latest']:
-        latest = tuple(map(int, feed['latest'].split()))
-        html = format_entries(get_old_entries(d.entries, latest)[:5])
+    old_entries = _filter_entries(feed, d.entries, new=False)[:5]
+    if old_entries:
+        db.set_rendered_entries(
+            feed['url'], ((e.hash, e.content, e.html) for e in old_entries),
+            time())
+        html = format_entries(old_entries)
         replies.add(text=text, html=html, chat=chat)
     else:
         replies.add(text=text, chat=chat)
@@ -123,6 +168,52 @@ def feed_unsub(payload: str, message: Message, replies: Replies) -> None:
     replies.add(text='Chat unsubscribed from: {}'.format(feed['url']))
 
 
+@simplebot.command(admin=True)
+def feed_quarantine(replies: Replies) -> None:
+    """List the feeds that keep failing and are checked only rarely.
+    """
+    text = '\n\n'.join(
+        '{}\n❌ {} failures, since {}\n{}'.format(
+            f['url'], f['failures'],
+            strftime('%Y-%m-%d %H:%M', gmtime(f['quarantined'])),
+            f['last_error']) for f in db.get_quarantined_feeds())
+    replies.add(text=text or 'No feeds in quarantine')
+
+
+@simplebot.command(admin=True)
+def feed_stats(payload: str, replies: Replies) -> None:
+    """Show the most expensive feeds.
+
+    Optionally pass the number of feeds to show and the metric to sort by:
+    fetch_time (default), bytes, parse_time, entries, new, fanout, checks
+    or errors. Send /feed_stats json to get all the metrics as a file.
+    """
+    args = payload.split()
+    if args == ['json']:
+        replies.add(filename='feed_stats.json',
+                    bytefile=io.BytesIO(stats.dump().encode()))
+        return
+    count, key = 10, 'fetch_time'
+    for arg in args:
+        if arg.isdigit():
+            count = int(arg)
+        elif arg in AVERAGES + ('checks', 'errors'):
+            key = arg
+        else:
+            replies.add(text='Unknown metric: {}'.format(arg))
+            return
+
+    text = '\n\n'.join(
+        '{}\n⏱️ {:.2f}s fetch, {:.2f}s parse, {:.0f} KB\n'
+        '📰 {:.1f} entries, {:.1f} new, {:.1f} messages\n'
+        '🔄 {} checks, {} errors, last: {}'.format(
+            url, s.get('avg_fetch_time', 0), s.get('avg_parse_time', 0),
+            s.get('avg_bytes', 0) / 1024, s.get('avg_entries', 0),
+            s.get('avg_new', 0), s.get('avg_fanout', 0), s['checks'],
+            s['errors'], s['status']) for url, s in stats.top(count, key))
+    replies.add(text=text or 'No feeds checked yet')
+
+
 @simplebot.command
 def feed_list(message: Message, replies: Replies) -> None:
     """List feed subscriptions for the current chat.
@@ -133,70 +224,337 @@ def feed_list(message: Message, replies: Replies) -> None:
 
 
 def _check_feeds(bot: DeltaBot) -> None:
+    fetcher = FeedFetcher(workers=int(_getdefault(bot, 'workers')),
+                          per_host=int(_getdefault(bot, 'workers_per_host')),
+                          timeout=float(_getdefault(bot, 'timeout')),
+                          processes=int(_getdefault(bot, 'parse_processes')),
+                          host_rate=float(_getdefault(bot, 'host_rate')),
+                          host_burst=int(_getdefault(bot, 'host_burst')))
+    saved = time()
     while True:
         bot.logger.debug('Checking feeds')
-        for f in db.get_feeds():
-            try:
-                _check_feed(bot, f)
-            except Exception as err:
-                bot.logger.exception(err)
-        sleep(int(_getdefault(bot, 'delay')))
+        next_check = None
+        try:
+            _check_pushed_feeds(bot)
+            _check_due_feeds(bot, fetcher)
+            if int(_getdefault(bot, 'websub_port')):
+                _renew_websub(bot, fetcher)
+            if time() - saved >= float(_getdefault(bot, 'stats_interval')):
+                _save_stats()
+                saved = time()
+            next_check = db.get_next_check(time())
+        except Exception as ex:
+            bot.logger.exception(ex)
+
+        min_delay = float(_getdefault(bot, 'min_delay'))
+        if next_check is None:
+            websub_event.wait(min_delay)
+        else:
+            websub_event.wait(min(max(next_check - time(), 1), min_delay))
+        websub_event.clear()
+
+
+def _check_due_feeds(bot: DeltaBot, fetcher: FeedFetcher) -> None:
+    """Run one checking cycle over the feeds that are due."""
+    feeds, fchats = [], {}
+    for f, gids in db.get_due_feeds(time()):
+        if gids:
+            feeds.append(f)
+            fchats[f['url']] = gids
+        else:
+            db.remove_feed(f['url'])
+    for f, resp, d, err in fetcher.fetch_all(feeds, _get_seen):
+        try:
+            if err is not None:
+                raise err
+            new_entries = 0
+            if d is not None:
+                new_entries = _check_feed(bot, f, d, fchats[f['url']])
+                _discover_hub(bot, f['url'], d)
+            else:
+                _update_validators(f, resp)
+                # the entries are still in the feed, keep them from expiring
+                db.touch_seen_entries(f['url'], time())
+        except Exception as ex:
+            bot.logger.exception(ex)
+            _record_stats(f, resp, d, 0, ex)
+            _reschedule(bot, f, 0, error=ex, wait=retry_after(ex))
+        else:
+            _record_stats(
+                f, resp, d, new_entries,
+                fanout=len(fchats[f['url']]) if new_entries else 0)
+            _reschedule(bot, f, new_entries, wait=resp.max_age)
+    db.prune_seen_entries(
+        time() - float(_getdefault(bot, 'seen_retention')))
+    db.evict_rendered_entries(int(_getdefault(bot, 'render_cache_size')))
+
+
+def _check_pushed_feeds(bot: DeltaBot) -> None:
+    """Process the feed updates pushed by the WebSub hubs."""
+    while True:
+        try:
+            url, resp = websub_queue.get_nowait()
+        except Empty:
+            return
+        try:
+            f = db.get_feed(url)
+            fchats = db.get_fchats(url) if f else []
+        except Exception as ex:
+            bot.logger.exception(ex)
+            continue
+        if not fchats:
+            continue
+        d = None
+        try:
+            seen, watermark = _get_seen(f)
+            d = parse(resp, seen or None, watermark=watermark)
+            # keep the validators of the polled document
+            d['etag'], d['modified'] = f['etag'], f['modified']
+            d['body_hash'] = f['body_hash']
+            new_entries = _check_feed(bot, f, d, fchats)
+        except Exception as ex:
+            bot.logger.exception(ex)
+            _record_stats(f, resp, d, 0, ex)
+        else:
+            _record_stats(f, resp, d, new_entries,
+                          fanout=len(fchats) if new_entries else 0)
+
+
+def _discover_hub(bot: DeltaBot, url: str, d: FeedParserDict) -> None:
+    hub = d.feed.get('hub')
+    if hub and int(_getdefault(bot, 'websub_port')):
+        db.set_websub_hub(url, hub, d.feed.get('topic') or url, new_token(),
+                          new_token())
+
+
+def _renew_websub(bot: DeltaBot, fetcher: FeedFetcher) -> None:
+    """Subscribe to the hubs of the feeds without a WebSub lease or with a
+    lease about to expire.
+    """
+    now = time()
+    lease = int(_getdefault(bot, 'websub_lease'))
+    base = _getdefault(bot, 'websub_url') or 'http://localhost:{}'.format(
+        _getdefault(bot, 'websub_port'))
+    renewals = db.get_websub_renewals(
+        now + float(_getdefault(bot, 'delay')),
+        now - float(_getdefault(bot, 'websub_retry')))
+    for sub in renewals:
+        db.set_websub_requested(sub['feed'], now)
+        callback = '{}/{}'.format(base.rstrip('/'), sub['token'])
+        fetcher.pool.submit(_subscribe, bot, sub, callback, lease, fetcher)
 
 
-def _check_feed(bot: DeltaBot, f: sqlite3.Row) -> None:
-    fchats = db.get_fchats(f['url'])
+def _subscribe(bot: DeltaBot, sub: sqlite3.Row, callback: str, lease: int,
+               fetcher: FeedFetcher) -> None:
+    try:
+        subscribe(sub['hub'], sub['topic'], callback, sub['secret'], lease,
+                  fetcher.timeout, fetcher.session)
+    except Exception as ex:
+        bot.logger.warning('WebSub subscription to %s failed: %s',
+                           sub['hub'], ex)
 
-    if not fchats:
-        db.remove_feed(f['url'])
-        return
 
-    bot.logger.debug('Checking feed: %s', f['url'])
-    d = feedparser.parse(
-        f['url'], etag=f['etag'], modified=f['modified'])
+def _get_subscription(token: str) -> Optional[Tuple[str, str, str]]:
+    sub = db.get_websub(token)
+    return (sub['feed'], sub['topic'], sub['secret']) if sub else None
 
-    bozo_exception = d.get('bozo_exception', '')
-    if d.get('bozo') == 1 and not isinstance(
-            bozo_exception, CharacterEncodingOverride):
-        bot.logger.exception(bozo_exception)
-        return
 
-    if d.entries and f['latest']:
-        d.entries = get_new_entries(
-            d.entries, tuple(map(int, f['latest'].split())))
-    if not d.entries:
-        return
+def _websub_verified(token: str, lease: int) -> None:
+    db.set_websub_lease(token, time() + lease if lease else 0)
 
-    html = format_entries(d.entries[:50])
-    replies = Replies(bot, logger=bot.logger)
-    for gid in fchats:
+
+def _websub_pushed(url: str, resp: Response) -> None:
+    websub_queue.put((url, resp))
+    websub_event.set()
+
+
+def _check_feed(bot: DeltaBot, f: sqlite3.Row, d: FeedParserDict,
+                fchats: List[int]) -> int:
+    """Send the new entries of the feed to the given chats, returns the
+    number of new entries.
+    """
+    bot.logger.debug('Checking feed: %s', f['url'])
+    if d.bozo:
+        raise d.bozo_exception
+
+    modified = d.get('modified')
+    entries = _filter_entries(f, d.entries, new=True)
+    db.add_seen_entries(f['url'], d.hashes, time())
+    if not entries:
+        db.update_feed(f['url'], d.get('etag'), modified, f['latest'],
+                       d.get('body_hash'))
+        return 0
+
+    entries = entries[:50]
+    db.set_rendered_entries(
+        f['url'], ((e.hash, e.content, e.html) for e in entries), time())
+    db.add_outbox(f['url'], format_entries(entries), fchats)
+    outbox_event.set()
+
+    # never move the watermark backwards, ex. with an older document or a
+    # push carrying only some entries
+    latest = _max_date(get_latest_date(entries), f['latest'])
+    db.update_feed(f['url'], d.get('etag'), modified, latest,
+                   d.get('body_hash'))
+    return len(entries)
+
+
+def _update_validators(f: sqlite3.Row, resp: Response) -> None:
+    """Save the validators of a feed that didn't change, servers may send
+    new ones even if the body is identical.
+    """
+    if resp.not_modified:  # a 304 only includes the validators that changed
+        etag = resp.headers.get('etag') or f['etag']
+        modified = resp.headers.get('last-modified') or f['modified']
+    else:
+        etag = resp.headers.get('etag')
+        modified = resp.headers.get('last-modified')
+    if (etag, modified) != (f['etag'], f['modified']):
+        db.update_feed(f['url'], etag, modified, f['latest'], f['body_hash'])
+
+
+def _send_outbox(bot: DeltaBot) -> None:
+    """Deliver the queued feed updates in small batches.
+    """
+    failures = 0
+    while True:
+        delay = float(_getdefault(bot, 'fanout_delay'))
         try:
-            replies.add(html=html, chat=bot.get_chat(gid))
-        except (ValueError, AttributeError):
-            db.remove_fchat(gid)
-    replies.send_reply_messages()
+            sent = _send_outbox_batch(bot)
+        except Exception as ex:
+            bot.logger.exception(ex)
+            failures += 1
+            sleep(min(delay * 2**failures, 60*60))
+            continue
+        failures = 0
+        if sent:
+            sleep(delay)
+        else:
+            outbox_event.wait()
+            outbox_event.clear()
+
+
+def _send_outbox_batch(bot: DeltaBot) -> int:
+    """Send the next batch of queued messages, returns the number of items
+    taken from the outbox.
+    """
+    batch = db.get_outbox(int(_getdefault(bot, 'fanout_batch')))
+    if not batch:
+        return 0
 
-    latest = get_latest_date(d.entries) or f['latest']
-    modified = d.get('modified') or d.get('updated')
-    db.update_feed(f['url'], d.get('etag'), modified, latest)
+    for i, item in enumerate(batch):
+        if item['subscribed']:
+            try:
+                chat = bot.get_chat(item['gid'])
+            except (ValueError, AttributeError):
+                db.remove_fchat(item['gid'])
+            else:
+                replies = Replies(bot, logger=bot.logger)
+                replies.add(html=item['html'], chat=chat)
+                try:
+                    replies.send_reply_messages()
+                except Exception:
+                    dropped = db.retry_outbox(
+                        (item['msg'] for item in batch[i:]),
+                        int(_getdefault(bot, 'fanout_retries')))
+                    if dropped:
+                        bot.logger.warning(
+                            'Dropped %s feed updates that could not be sent',
+                            dropped)
+                    raise
+        db.remove_outbox([(item['msg'], item['gid'])])
+    return len(batch)
+
+
+def _reschedule(bot: DeltaBot, f: sqlite3.Row, new_entries: int,
+                error: Exception = None, wait: float = None) -> None:
+    """Set the next time the feed should be checked.
+    """
+    now = time()
+    max_delay = float(_getdefault(bot, 'max_delay'))
+    interval = f['interval'] or float(_getdefault(bot, 'delay'))
+    last_new = f['last_new']
+    failures, last_error, quarantined = 0, None, None
+    if error:
+        failures = f['failures'] + 1
+        last_error = repr(error)
+        quarantined = f['quarantined']
+        if failures >= int(_getdefault(bot, 'max_failures')):
+            quarantined = quarantined or now
+            delay = float(_getdefault(bot, 'quarantine_delay'))
+        else:
+            delay = min(interval * 2**failures, max_delay)
+    else:
+        if new_entries:
+            if last_new:
+                interval = (interval + (now - last_new) / new_entries) / 2
+            last_new = now
+        else:
+            interval *= 1.5
+        interval = min(
+            max(interval, float(_getdefault(bot, 'min_delay'))), max_delay)
+        delay = interval
+    delay = max(delay, min(wait or 0, max_delay))
+    db.schedule_feed(f['url'], now + delay, interval, last_new, failures,
+                     last_error, quarantined)
+
+
+def _record_stats(f: sqlite3.Row, resp: Optional[Response],
+                  d: Optional[FeedParserDict], new_entries: int,
+                  error: Exception = None, fanout: int = 0) -> None:
+    if error is None:
+        status = resp.status
+    else:
+        status = getattr(getattr(error, 'response', None), 'status_code',
+                         None) or type(error).__name__
+    stats.record(
+        f['url'], status,
+        fetch_time=resp.elapsed if resp else None,
+        bytes=len(resp.body) if resp else None,
+        parse_time=d.get('parse_time') if d else None,
+        entries=len(d.hashes) if d else None,
+        new=new_entries,
+        fanout=fanout,
+    )
+
+
+def _save_stats() -> None:
+    """Persist the feed metrics updated since the last save."""
+    stats.retain(f['url'] for f in db.get_feeds())
+    db.save_feed_stats(stats.pop_dirty())
+
+
+def _parse_url(bot: DeltaBot, url: str, rendered: dict = None
+               ) -> FeedParserDict:
+    try:
+        resp = fetch(url, timeout=float(_getdefault(bot, 'timeout')))
+        return parse(resp, rendered=rendered)
+    except Exception as err:
+        return FeedParserDict(
+            bozo=1, bozo_exception=FeedError(repr(err)), entries=[],
+            hashes=[], feed=FeedParserDict())
 
 
 def format_entries(entries: list) -> str:
-    entries_text = []
-    for e in entries:
-        t = '<a href="{}"><h3>{}</h3></a>'.format(
-            e.get('link') or '', e.get('title') or 'NO TITLE')
-        pub_date = e.get('published')
-        if pub_date:
-            t += '<p>📆 <small><em>{}</em></small></p>'.format(pub_date)
-        desc = e.get('description') or ''
-        if not desc and e.get('content'):
-            for c in e.get('content'):
-                if c.get('type') == 'text/html':
-                    desc += c['value']
-        if desc and desc != e.get('title'):
-            t += desc
-        entries_text.append(t)
-    return '<br><hr>'.join(entries_text)
+    return '<br><hr>'.join(e.html for e in entries)
+
+
+def _get_seen(f: sqlite3.Row) -> Tuple[Set[int], Optional[tuple]]:
+    latest = tuple(map(int, f['latest'].split())) if f['latest'] else None
+    return db.get_seen_entries(f['url']), latest
+
+
+def _filter_entries(f: sqlite3.Row, entries: list, new: bool) -> list:
+    """Get the entries of the given feed that were (not) seen before."""
+    seen = db.get_seen_entries(f['url'])
+    if seen:
+        return [e for e in entries if (e.hash not in seen) == new]
+    if f['latest']:  # feed added before entries were tracked
+        date = tuple(map(int, f['latest'].split()))
+        if new:
+            return get_new_entries(entries, date)
+        return get_old_entries(entries, date)
+    return entries if new else []
 
 
 def get_new_entries(entries: list, date: tuple) -> list:
@@ -226,6 +584,12 @@ def get_latest_date(entries: list) -> Optional[str]:
     return ' '.join(map(str, max(dates))) if dates else None
 
 
+def _max_date(*dates: Optional[str]) -> Optional[str]:
+    dates = [d for d in dates if d]
+    return max(dates, key=lambda d: tuple(map(int, d.split())),
+               default=None)
+
+
 def _getdefault(bot: DeltaBot, key: str, value=None) -> str:
     val = bot.get(key, scope=__name__)
     if val is None and value is not None:
@@ -1,12 +1,19 @@
+import json
 import sqlite3
-from typing import List, Optional
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 
 class DBManager:
     def __init__(self, db_path: str) -> None:
+        # the connection is shared by the checker, outbox and WebSub threads,
+        # every statement and transaction holds this lock
+        self.lock = threading.RLock()
         self.db = sqlite3.connect(db_path, check_same_thread=False)
         self.db.row_factory = sqlite3.Row
-        with self.db:
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.lock, self.db:
             self.db.execute(
                 '''CREATE TABLE IF NOT EXISTS feeds
                 (url TEXT PRIMARY KEY,
@@ -18,53 +25,163 @@ class DBManager:
                 (gid INTEGER,
                 feed TEXT REFERENCES feeds(url),
                  PRIMARY KEY(gid, feed))''')
+            self.db.execute(
+                '''CREATE INDEX IF NOT EXISTS fchats_feed
+                ON fchats (feed)''')
+            self._add_columns('feeds', (
+                ('next_check', 'REAL NOT NULL DEFAULT 0'),
+                ('interval', 'REAL'),
+                ('last_new', 'REAL'),
+                ('body_hash', 'TEXT'),
+                ('failures', 'INTEGER NOT NULL DEFAULT 0'),
+                ('last_error', 'TEXT'),
+                ('quarantined', 'REAL'),
+            ))
+            self.db.execute(
+                '''CREATE INDEX IF NOT EXISTS feeds_next_check
+                ON feeds (next_check)''')
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS seen_entries
+                (feed TEXT REFERENCES feeds(url),
+                hash INTEGER,
+                seen REAL NOT NULL,
+                PRIMARY KEY(feed, hash))''')
+            self.db.execute(
+                '''CREATE INDEX IF NOT EXISTS seen_entries_seen
+                ON seen_entries (seen)''')
+            self._add_columns('seen_entries', (
+                ('content', 'INTEGER'),
+                ('html', 'TEXT'),
+                ('used', 'REAL'),
+            ))
+            self.db.execute(
+                '''CREATE INDEX IF NOT EXISTS seen_entries_used
+                ON seen_entries (used) WHERE html IS NOT NULL''')
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS outbox
+                (id INTEGER PRIMARY KEY,
+                feed TEXT NOT NULL,
+                html TEXT NOT NULL)''')
+            self._add_columns('outbox', (
+                ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+            ))
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS outbox_chats
+                (msg INTEGER REFERENCES outbox(id),
+                gid INTEGER,
+                PRIMARY KEY(msg, gid))''')
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS websub
+                (feed TEXT PRIMARY KEY REFERENCES feeds(url),
+                hub TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                token TEXT NOT NULL UNIQUE,
+                secret TEXT NOT NULL,
+                requested REAL NOT NULL DEFAULT 0,
+                expires REAL NOT NULL DEFAULT 0)''')
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS feed_stats
+                (feed TEXT PRIMARY KEY REFERENCES feeds(url),
+                data TEXT NOT NULL)''')
+
+    def _add_columns(self, table: str, columns: tuple) -> None:
+        existing = [r['name'] for r in self.db.execute(
+            'PRAGMA table_info({})'.format(table))]
+        for name, definition in columns:
+            if name not in existing:
+                self.db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table, name, definition))
 
     def execute(self, statement: str, args=()) -> sqlite3.Cursor:
-        return self.db.execute(statement, args)
+        with self.lock:
+            return self.db.execute(statement, args)
 
     def commit(self, statement: str, args=()) -> sqlite3.Cursor:
-        with self.db:
+        with self.lock, self.db:
             return self.db.execute(statement, args)
 
     def close(self) -> None:
-        self.db.close()
+        with self.lock:
+            self.db.close()
 
     # ==== feeds =====
 
-    def add_feed(self, url: str, etag: str, modified: str, latest: str) -> None:
+    def add_feed(self, url: str, etag: str, modified: str, latest: str,
+                 next_check: float = 0, interval: float = None) -> None:
         url = self.normalize_url(url)
-        with self.db:
-            self.db.execute('INSERT INTO feeds VALUES (?,?,?,?)',
-                            (url, etag, modified, latest))
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO feeds (url, etag, modified, latest, next_check,'
+                ' interval) VALUES (?,?,?,?,?,?)',
+                (url, etag, modified, latest, next_check, interval))
 
     def remove_feed(self, url: str) -> None:
         url = self.normalize_url(url)
-        with self.db:
+        with self.lock, self.db:
             self.db.execute('DELETE FROM fchats WHERE feed=?', (url,))
+            self.db.execute('DELETE FROM seen_entries WHERE feed=?', (url,))
+            self.db.execute('DELETE FROM feed_stats WHERE feed=?', (url,))
+            self.db.execute('DELETE FROM websub WHERE feed=?', (url,))
             self.db.execute('DELETE FROM feeds WHERE url=?', (url,))
 
     def update_feed(self, url: str, etag: Optional[str],
-                    modified: Optional[str], latest: Optional[str]) -> None:
+                    modified: Optional[str], latest: Optional[str],
+                    body_hash: str = None) -> None:
         url = self.normalize_url(url)
-        q = 'UPDATE feeds SET etag=?, modified=?, latest=? WHERE url=?'
-        self.commit(q, (etag, modified, latest, url))
+        q = 'UPDATE feeds SET etag=?, modified=?, latest=?, body_hash=?'
+        q += ' WHERE url=?'
+        self.commit(q, (etag, modified, latest, body_hash, url))
+
+    def schedule_feed(self, url: str, next_check: float, interval: float,
+                      last_new: Optional[float], failures: int = 0,
+                      last_error: str = None,
+                      quarantined: float = None) -> None:
+        q = 'UPDATE feeds SET next_check=?, interval=?, last_new=?,'
+        q += ' failures=?, last_error=?, quarantined=? WHERE url=?'
+        self.commit(q, (next_check, interval, last_new, failures,
+                        last_error, quarantined, url))
+
+    def get_quarantined_feeds(self) -> List[sqlite3.Row]:
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM feeds WHERE quarantined IS NOT NULL'
+                ' ORDER BY quarantined').fetchall()
+
+    def get_due_feeds(self, now: float
+                      ) -> List[Tuple[sqlite3.Row, List[int]]]:
+        """Get the feeds due to be checked, and the chats subscribed to each
+        of them. Feeds with an active WebSub lease are not polled.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT f.*, group_concat(c.gid) AS gids FROM feeds f'
+                ' LEFT JOIN fchats c ON c.feed=f.url WHERE f.next_check<=?'
+                ' AND NOT EXISTS (SELECT 1 FROM websub w WHERE w.feed=f.url'
+                ' AND w.expires>?)'
+                ' GROUP BY f.url ORDER BY f.next_check', (now, now)).fetchall()
+        return [(r, [int(gid) for gid in r['gids'].split(',')]
+                 if r['gids'] else []) for r in rows]
+
+    def get_next_check(self, now: float) -> Optional[float]:
+        with self.lock:
+            return self.db.execute(
+                'SELECT MIN(next_check) FROM feeds f WHERE NOT EXISTS'
+                ' (SELECT 1 FROM websub w WHERE w.feed=f.url AND w.expires>?)',
+                (now,)).fetchone()[0]
 
     def get_feed(self, url: str) -> Optional[sqlite3.Row]:
         url = self.normalize_url(url)
-        return self.db.execute(
-            'SELECT * FROM feeds WHERE url=?', (url,)).fetchone()
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM feeds WHERE url=?', (url,)).fetchone()
 
     def get_feeds(self, gid: int = None) -> List[sqlite3.Row]:
-        if gid is None:
-            return self.db.execute('SELECT * FROM feeds').fetchall()
-        rows = self.db.execute(
-            'SELECT feed FROM fchats WHERE gid=?', (gid,)).fetchall()
-        if not rows:
-            return []
-        rows = [r[0] for r in rows]
-        q = 'SELECT * FROM feeds WHERE '
-        q += ' or '.join('url=?' for r in rows)
-        return self.db.execute(q, rows).fetchall()
+        with self.lock:
+            if gid is None:
+                return self.db.execute('SELECT * FROM feeds').fetchall()
+            return self.db.execute(
+                'SELECT f.* FROM fchats c JOIN feeds f ON f.url=c.feed'
+                ' WHERE c.gid=?', (gid,)).fetchall()
 
     def add_fchat(self, gid: int, url: str) -> None:
         url = self.normalize_url(url)
@@ -80,9 +197,183 @@ class DBManager:
 
     def get_fchats(self, url: str) -> List[int]:
         url = self.normalize_url(url)
-        rows = self.db.execute('SELECT gid FROM fchats WHERE feed=?', (url,))
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT gid FROM fchats WHERE feed=?', (url,)).fetchall()
         return [r[0] for r in rows]
 
+    # ==== seen_entries =====
+
+    def add_seen_entries(self, url: str, hashes: Iterable[int],
+                         seen: float) -> None:
+        """Mark the given entries as seen, or refresh their timestamp if
+        they were already seen.
+        """
+        url = self.normalize_url(url)
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT INTO seen_entries (feed, hash, seen) VALUES (?,?,?)'
+                ' ON CONFLICT(feed, hash) DO UPDATE SET seen=excluded.seen',
+                ((url, h, seen) for h in hashes))
+
+    def touch_seen_entries(self, url: str, seen: float) -> None:
+        """Refresh the timestamp of all the seen entries of the feed."""
+        url = self.normalize_url(url)
+        self.commit('UPDATE seen_entries SET seen=? WHERE feed=?',
+                    (seen, url))
+
+    def get_seen_entries(self, url: str) -> Set[int]:
+        url = self.normalize_url(url)
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT hash FROM seen_entries WHERE feed=?',
+                (url,)).fetchall()
+        return {r[0] for r in rows}
+
+    def prune_seen_entries(self, before: float, limit: int = 1000) -> None:
+        """Forget at most `limit` entries not seen since the given time."""
+        self.commit(
+            'DELETE FROM seen_entries WHERE rowid IN (SELECT rowid FROM'
+            ' seen_entries WHERE seen<? LIMIT ?)', (before, limit))
+
+    def set_rendered_entries(self, url: str,
+                             entries: Iterable[Tuple[int, int, str]],
+                             used: float) -> None:
+        """Cache the HTML of the given `(hash, content_hash, html)` seen
+        entries, or mark it as recently used if already cached.
+        """
+        url = self.normalize_url(url)
+        with self.lock, self.db:
+            self.db.executemany(
+                'UPDATE seen_entries SET content=?, html=?, used=?'
+                ' WHERE feed=? AND hash=?',
+                ((content, html, used, url, h)
+                 for h, content, html in entries))
+
+    def get_rendered_entries(self, url: str) -> Dict[Tuple[int, int], str]:
+        """Get the cached HTML of the feed entries, by
+        `(hash, content_hash)`.
+        """
+        url = self.normalize_url(url)
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT hash, content, html FROM seen_entries'
+                ' WHERE feed=? AND html IS NOT NULL', (url,)).fetchall()
+        return {(r[0], r[1]): r[2] for r in rows}
+
+    def evict_rendered_entries(self, size: int) -> None:
+        """Drop the cached HTML of the least recently used entries so only
+        `size` are kept.
+        """
+        self.commit(
+            'UPDATE seen_entries SET html=NULL WHERE rowid IN (SELECT rowid'
+            ' FROM seen_entries WHERE html IS NOT NULL ORDER BY used DESC'
+            ' LIMIT -1 OFFSET ?)', (size,))
+
+    # ==== outbox =====
+
+    def add_outbox(self, url: str, html: str, gids: Iterable[int]) -> None:
+        """Queue the given HTML to be sent to the given chats."""
+        url = self.normalize_url(url)
+        with self.lock, self.db:
+            msg = self.db.execute(
+                'INSERT INTO outbox (feed, html) VALUES (?,?)',
+                (url, html)).lastrowid
+            self.db.executemany(
+                'INSERT INTO outbox_chats VALUES (?,?)',
+                ((msg, gid) for gid in gids))
+
+    def get_outbox(self, limit: int) -> List[sqlite3.Row]:
+        """Get the next items to send, `subscribed` is 0 if the chat
+        unsubscribed from the feed after the item was queued.
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT c.msg, c.gid, o.html, o.attempts,'
+                ' s.gid IS NOT NULL AS subscribed'
+                ' FROM outbox_chats c JOIN outbox o ON o.id=c.msg'
+                ' LEFT JOIN fchats s ON s.gid=c.gid AND s.feed=o.feed'
+                ' ORDER BY c.msg LIMIT ?', (limit,)).fetchall()
+
+    def remove_outbox(self, items: Iterable[Tuple[int, int]]) -> None:
+        """Remove the given (msg, gid) pairs from the outbox, dropping the
+        messages that have no more chats to be sent to.
+        """
+        with self.lock, self.db:
+            self.db.executemany(
+                'DELETE FROM outbox_chats WHERE msg=? AND gid=?', items)
+            self.db.execute(
+                'DELETE FROM outbox WHERE id NOT IN'
+                ' (SELECT DISTINCT msg FROM outbox_chats)')
+
+    def retry_outbox(self, msgs: Iterable[int], max_attempts: int) -> int:
+        """Count a failed attempt to send the given messages, returns the
+        number of messages dropped after `max_attempts`.
+        """
+        with self.lock, self.db:
+            self.db.executemany(
+                'UPDATE outbox SET attempts=attempts+1 WHERE id=?',
+                ((msg,) for msg in set(msgs)))
+            self.db.execute(
+                'DELETE FROM outbox_chats WHERE msg IN'
+                ' (SELECT id FROM outbox WHERE attempts>=?)', (max_attempts,))
+            return self.db.execute(
+                'DELETE FROM outbox WHERE attempts>=?',
+                (max_attempts,)).rowcount
+
+    # ==== websub =====
+
+    def set_websub_hub(self, url: str, hub: str, topic: str, token: str,
+                       secret: str) -> None:
+        """Record the WebSub hub advertised by the feed.
+        """
+        url = self.normalize_url(url)
+        # the token and secret are kept, a new hub or topic is subscribed again
+        self.commit(
+            'INSERT INTO websub (feed, hub, topic, token, secret)'
+            ' VALUES (?,?,?,?,?) ON CONFLICT(feed) DO UPDATE'
+            ' SET hub=excluded.hub, topic=excluded.topic, requested=0,'
+            ' expires=0 WHERE hub!=excluded.hub OR topic!=excluded.topic',
+            (url, hub, topic, token, secret))
+
+    def get_websub(self, token: str) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM websub WHERE token=?', (token,)).fetchone()
+
+    def get_websub_renewals(self, expires: float, requested: float
+                            ) -> List[sqlite3.Row]:
+        """Get the subscriptions whose lease ends before `expires` and
+        that were not requested after `requested`.
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM websub WHERE expires<? AND requested<?',
+                (expires, requested)).fetchall()
+
+    def set_websub_requested(self, url: str, requested: float) -> None:
+        self.commit('UPDATE websub SET requested=? WHERE feed=?',
+                    (requested, url))
+
+    def set_websub_lease(self, token: str, expires: float) -> None:
+        self.commit('UPDATE websub SET expires=? WHERE token=?',
+                    (expires, token))
+
+    # ==== feed_stats =====
+
+    def save_feed_stats(self, rows: Iterable[Tuple[str, dict]]) -> None:
+        with self.lock, self.db:
+            self.db.executemany(
+                'REPLACE INTO feed_stats VALUES (?,?)',
+                ((url, json.dumps(data)) for url, data in rows))
+
+    def get_feed_stats(self) -> List[Tuple[str, dict]]:
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT s.feed, s.data FROM feed_stats s'
+                ' JOIN feeds f ON f.url=s.feed').fetchall()
+        return [(r['feed'], json.loads(r['data'])) for r in rows]
+
     def normalize_url(self, url: str) -> str:
         if not url.startswith('http'):
             url = 'http://'+url
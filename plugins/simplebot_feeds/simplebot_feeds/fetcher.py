@@ -0,0 +1,281 @@
+import hashlib
+import multiprocessing
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Executor, Future,
+                                ProcessPoolExecutor, ThreadPoolExecutor, wait)
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import parsedate_to_datetime
+from typing import (Callable, Dict, Generator, Iterable, Optional, Set,
+                    Tuple)
+from urllib.parse import urlparse
+
+import feedparser
+import requests
+from feedparser.http import ACCEPT_HEADER
+from feedparser.util import FeedParserDict
+from requests.adapters import HTTPAdapter
+
+from .parser import parse_feed
+
+
+class Response:
+    """Raw result of fetching a feed URL, before any parsing."""
+
+    def __init__(self, url: str, status: int, headers: Dict[str, str],
+                 body: bytes, elapsed: float = 0) -> None:
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.elapsed = elapsed
+        self.hash = hashlib.sha1(body).hexdigest() if body else None
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status == 304
+
+    @property
+    def max_age(self) -> Optional[float]:
+        """Seconds the response may be cached according to the server."""
+        cache_control = self.headers.get('cache-control', '')
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return None
+        match = re.search(r'(?<![-\w])max-age=(\d+)', cache_control)
+        return float(match.group(1)) if match else None
+
+
+class TokenBucket:
+    """Allow up to `burst` requests at once, refilled at `rate` per second.
+
+    A `rate` of zero or less means no limit.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, blocking until one is available."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def new_session(pool_size: int = 10) -> requests.Session:
+    """Create a keep-alive session keeping up to `pool_size` connections
+    per host.
+    """
+    session = requests.Session()
+    session.headers.update({
+        'User-Agent': feedparser.USER_AGENT,
+        'Accept': ACCEPT_HEADER,
+    })
+    adapter = HTTPAdapter(pool_connections=256, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_session = new_session()
+
+
+def fetch(url: str, etag: str = None, modified: str = None,
+          timeout: float = 30, session: requests.Session = None) -> Response:
+    """Download the given feed, sending the cache validators if available.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    start = time.perf_counter()
+    with (session or _session).get(url, headers=headers,
+                                   timeout=timeout) as resp:
+        resp.raise_for_status()
+        headers = {k.lower(): v for k, v in resp.headers.items()}
+        # requests already decoded the body
+        headers.pop('content-encoding', None)
+        return Response(resp.url, resp.status_code, headers, resp.content,
+                        time.perf_counter() - start)
+
+
+def retry_after(err: Exception) -> Optional[float]:
+    """Get the seconds to wait before retrying, if the server requested it
+    in a failed response.
+    """
+    resp = getattr(err, 'response', None)
+    value = resp.headers.get('retry-after') if resp is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+def parse(resp: Response, seen: Set[int] = None, limit: int = 50,
+          watermark: tuple = None, rendered: dict = None) -> FeedParserDict:
+    """Parse an already downloaded feed, see `parse_feed()`.
+
+    `parse_time` is set to the seconds spent parsing.
+    """
+    start = time.perf_counter()
+    headers = dict(resp.headers)
+    headers.setdefault('content-location', resp.url)
+    d = parse_feed(resp.body, headers, seen, limit, watermark, rendered)
+    if 'link' in resp.headers and not d.feed.get('hub'):
+        # WebSub discovery through the HTTP Link header
+        for link in requests.utils.parse_header_links(resp.headers['link']):
+            key = {'hub': 'hub', 'self': 'topic'}.get(link.get('rel'))
+            if key and not d.feed.get(key):
+                d.feed[key] = link.get('url')
+    d['parse_time'] = time.perf_counter() - start
+    d['etag'] = resp.headers.get('etag')
+    d['modified'] = resp.headers.get('last-modified')
+    d['body_hash'] = resp.hash
+    return d
+
+
+class FeedFetcher:
+    """Fetch many feeds concurrently.
+
+    Downloads run in a bounded thread pool over a shared keep-alive session,
+    with at most `per_host` requests in flight against the same host and no
+    more than `host_rate` requests per second to it on average (allowing
+    bursts of `host_burst`), parsing is done as a separate
+    step once the connection was released, in the same thread pool or, if
+    `processes` is greater than zero, in a pool of worker processes so it
+    doesn't compete for the GIL with the rest of the bot. Results are
+    yielded back to the caller's thread as they complete, so all database
+    writes and message sending happen in a single thread.
+    """
+
+    def __init__(self, workers: int = 8, per_host: int = 2,
+                 timeout: float = 30, processes: int = 0,
+                 host_rate: float = 1, host_burst: int = 5) -> None:
+        self.per_host = max(per_host, 1)
+        self.timeout = timeout
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.session = new_session(self.per_host)
+        self.pool = ThreadPoolExecutor(
+            max_workers=max(workers, 1), thread_name_prefix='feeds')
+        self.processes = processes
+        self.parser: Executor = self.pool
+        if processes > 0:
+            self.parser = self._new_parser()
+
+    def fetch_all(self, feeds: Iterable[sqlite3.Row],
+                  get_seen: Callable[[sqlite3.Row], Tuple[
+                      Set[int], Optional[tuple]]] = None,
+                  limit: int = 50) -> Generator[
+            Tuple[sqlite3.Row, Optional[Response],
+                  Optional[FeedParserDict], Optional[Exception]],
+            None, None]:
+        """Fetch and parse the given feeds, yielding `(feed, response, d,
+        error)` tuples in completion order.
+
+        `d` is None if the feed was not modified, either because the server
+        replied 304 or because the body is identical to the one with hash
+        `feed['body_hash']`, in that case the feed is not parsed at all.
+        If `get_seen` is given, it is called with the feed before parsing it
+        to get the hashes of its known entries and the date of the newest
+        one, and only up to `limit` new entries are extracted.
+        """
+        queues: Dict[str, deque] = {}
+        for f in feeds:
+            queues.setdefault(urlparse(f['url']).netloc, deque()).append(f)
+        active: Dict[str, int] = {host: 0 for host in queues}
+        pending: Dict[Future, Tuple[str, sqlite3.Row, Optional[Response],
+                                    Executor]] = {}
+
+        def submit_next(host: str) -> None:
+            queue = queues[host]
+            while queue and active[host] < self.per_host:
+                f = queue.popleft()
+                active[host] += 1
+                fut = self.pool.submit(self.fetch, host, f)
+                pending[fut] = (host, f, None, self.pool)
+
+        for host in queues:
+            submit_next(host)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                host, f, resp, executor = pending.pop(fut)
+                if resp is None:  # download finished
+                    active[host] -= 1
+                    submit_next(host)
+                err = fut.exception()
+                if err is not None:
+                    if isinstance(err, BrokenProcessPool):
+                        self._restart_parser(executor)
+                    yield f, resp, None, err
+                elif resp is None:
+                    resp = fut.result()
+                    if resp.not_modified or resp.hash == f['body_hash']:
+                        yield f, resp, None, None
+                        continue
+                    executor = self.parser
+                    try:
+                        seen, watermark = get_seen(f) if get_seen else (
+                            None, None)
+                        pending[executor.submit(
+                            parse, resp, seen or None, limit, watermark)] = (
+                            host, f, resp, executor)
+                    except Exception as ex:
+                        if isinstance(ex, BrokenProcessPool):
+                            self._restart_parser(executor)
+                        yield f, resp, None, ex
+                else:
+                    yield f, resp, fut.result(), None
+
+    def fetch(self, host: str, f: sqlite3.Row) -> Response:
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets.setdefault(
+                host, TokenBucket(self.host_rate, self.host_burst))
+        bucket.acquire()
+        return fetch(f['url'], f['etag'], f['modified'], self.timeout,
+                     self.session)
+
+    def _restart_parser(self, broken: Executor) -> None:
+        """Replace the process pool after one of its workers died."""
+        if self.parser is broken and self.parser is not self.pool:
+            broken.shutdown(wait=False)
+            self.parser = self._new_parser()
+
+    def _new_parser(self) -> Executor:
+        # forking the bot's process would copy its threads' locks and the
+        # database connections into the workers
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('spawn'))
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=False)
+        if self.parser is not self.pool:
+            self.parser.shutdown(wait=False)
+        self.session.close()
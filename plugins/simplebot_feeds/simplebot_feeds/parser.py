@@ -0,0 +1,286 @@
+import hashlib
+import html
+import io
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import feedparser
+from feedparser.exceptions import CharacterEncodingOverride
+from feedparser.urls import make_safe_absolute_uri, resolve_relative_uris
+from feedparser.util import FeedParserDict
+
+from .sanitizer import sanitize_html
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+RSS1 = '{http://purl.org/rss/1.0/}'
+RSS090 = '{http://my.netscape.com/rdf/simple/0.9/}'
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+CONTENT = '{http://purl.org/rss/1.0/modules/content/}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+FEED_TAGS = {'rss': ('channel',), ATOM + 'feed': (ATOM + 'feed',),
+             RDF + 'RDF': (RSS1 + 'channel', RSS090 + 'channel')}
+ENTRY_TAGS = {'item', ATOM + 'entry', RSS1 + 'item', RSS090 + 'item'}
+
+
+class FeedError(Exception):
+    """The feed document could not be parsed."""
+
+
+def parse_feed(body: bytes, headers: Dict[str, str], seen: Set[int] = None,
+               limit: int = 50, watermark: tuple = None,
+               rendered: Dict[Tuple[int, int], str] = None
+               ) -> FeedParserDict:
+    """Parse a feed document into the compact form used by the bot.
+
+    Only the data needed to detect new entries and send them is kept, with
+    the entries already rendered to HTML, so the result is small and can be
+    cheaply sent back from a worker process. `hashes` contains the hashes
+    of all the entries that were read.
+
+    If the `seen` entry hashes are given, only unseen entries are rendered
+    and reading stops after `limit` of them were found, or, in feeds sorted
+    from newest to oldest, at the first seen entry older than the
+    `watermark` date. Otherwise the first `limit` entries are rendered.
+    Entries found in the `rendered` cache, a dict mapping `(hash,
+    content_hash)` to HTML, are not rendered again.
+
+    Well-formed RSS/Atom documents are read incrementally, dropping each
+    entry once processed, so big feeds don't need to be kept in memory;
+    other documents, or those without entries or with dates in unusual
+    formats, are handed to feedparser.
+    """
+    base = headers.get('content-location', '')
+    try:
+        d = _iterparse_feed(body, base, seen, limit, watermark, rendered)
+    except (ET.ParseError, LookupError, ValueError):
+        d = None
+    if d is not None:
+        return d
+
+    d = feedparser.parse(body, response_headers=headers)
+    bozo_exception = d.get('bozo_exception')
+    if d.get('bozo') == 1 and not isinstance(
+            bozo_exception, CharacterEncodingOverride):
+        return FeedParserDict(
+            bozo=1, bozo_exception=FeedError(repr(bozo_exception)),
+            feed=FeedParserDict(), entries=[], hashes=[])
+    return _compact_feed(
+        d.feed, iter(d.entries), seen, limit, watermark, rendered)
+
+
+def _compact_feed(feed: dict, entries: Iterator[dict],
+                  seen: Optional[Set[int]], limit: int,
+                  watermark: Optional[tuple], rendered: Optional[dict]
+                  ) -> FeedParserDict:
+    compact, hashes = [], []
+    last_date = None
+    for entry in entries:
+        h = entry_hash(entry)
+        hashes.append(h)
+        if seen is None:
+            if len(compact) < limit:
+                compact.append(compact_entry(entry, h, rendered))
+            continue
+        if h not in seen:
+            compact.append(compact_entry(entry, h, rendered))
+            if len(compact) >= limit:
+                break
+            continue
+        date = entry.get('published_parsed') or entry.get('updated_parsed')
+        if not date or (last_date and tuple(date) > last_date):
+            watermark = None  # not sorted by date, read everything
+        elif watermark and tuple(date) < watermark:
+            break
+        last_date = tuple(date) if date else None
+    links = {link.get('rel'): link.get('href')
+             for link in feed.get('links') or ()}
+    return FeedParserDict(
+        bozo=0,
+        feed=FeedParserDict(
+            title=feed.get('title'),
+            description=feed.get('description'),
+            hub=links.get('hub'),
+            topic=links.get('self'),
+        ),
+        entries=compact,
+        hashes=hashes,
+    )
+
+
+def _iterparse_feed(body: bytes, base: str, seen: Optional[Set[int]],
+                    limit: int, watermark: Optional[tuple],
+                    rendered: Optional[dict]) -> Optional[FeedParserDict]:
+    events = ET.iterparse(io.BytesIO(body), events=('start', 'end'))
+    _, root = next(events)
+    if root.tag not in FEED_TAGS:
+        return None
+    feed_tags = FEED_TAGS[root.tag]
+    feed: dict = {}
+
+    def iter_entries() -> Iterator[dict]:
+        stack = [root]
+        for event, elem in events:
+            if event == 'start':
+                stack.append(elem)
+                continue
+            stack.pop()
+            parent = stack[-1] if stack else None
+            if elem.tag in ENTRY_TAGS:
+                entry = _read_entry(elem, base)
+                parent.remove(elem)
+                yield entry
+            elif parent is not None and parent.tag in feed_tags:
+                tag = elem.tag.split('}')[-1]
+                if tag == 'title':
+                    feed.setdefault('title', _text(elem))
+                elif tag in ('description', 'subtitle'):
+                    feed.setdefault('description', _text(elem))
+                elif tag == 'link' and elem.get('href'):
+                    feed.setdefault('links', []).append(
+                        {'rel': elem.get('rel'), 'href': elem.get('href')})
+
+    d = _compact_feed(
+        feed, iter_entries(), seen, limit, watermark, rendered)
+    return d if d.hashes else None
+
+
+def _read_entry(elem: ET.Element, base: str) -> dict:
+    entry: dict = {}
+    if elem.get(RDF + 'about'):
+        entry['id'] = elem.get(RDF + 'about')
+    for child in elem:
+        tag = child.tag.split('}')[-1]
+        if tag == 'link':
+            if child.get('href') is not None:  # Atom
+                if child.get('rel', 'alternate') == 'alternate':
+                    entry.setdefault('link', child.get('href'))
+            else:
+                entry.setdefault('link', (child.text or '').strip())
+        elif tag in ('guid', 'id'):
+            entry['id'] = (child.text or '').strip()
+        elif tag == 'title':
+            entry['title'] = _markup(child)
+        elif tag in ('pubDate', 'published', 'issued'):
+            entry['published'] = (child.text or '').strip()
+        elif tag in ('updated', 'modified') or child.tag == DC + 'date':
+            entry['updated'] = (child.text or '').strip()
+        elif tag in ('description', 'summary'):
+            entry['description'] = _markup(child)
+        elif child.tag in (CONTENT + 'encoded', ATOM + 'content'):
+            entry.setdefault('content', []).append(
+                {'type': 'text/html', 'value': _markup(child)})
+    # ids are kept verbatim, like feedparser does, so both give the same hash
+    if entry.get('link'):
+        entry['link'] = make_safe_absolute_uri(base, entry['link'])
+    for key in ('published', 'updated'):
+        if entry.get(key):
+            entry[key + '_parsed'] = _parse_date(entry[key])
+    for key in ('description', 'title'):
+        if entry.get(key) and '<' in entry[key]:
+            entry[key] = sanitize_html(resolve_relative_uris(
+                entry[key], base, 'utf-8', 'text/html'))
+    for c in entry.get('content', ()):
+        if '<' in c['value']:
+            c['value'] = sanitize_html(resolve_relative_uris(
+                c['value'], base, 'utf-8', 'text/html'))
+    return entry
+
+
+def _parse_date(value: str) -> time.struct_time:
+    """Parse an RFC 822 or ISO 8601 date into a UTC struct_time.
+
+    Raises ValueError for other formats, so the document is handed to
+    feedparser, which understands many more.
+    """
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        date = None
+    if date is None:
+        if value[-1:] in ('Z', 'z'):
+            value = value[:-1] + '+00:00'
+        date = datetime.fromisoformat(value)
+    return date.utctimetuple()
+
+
+def _markup(elem: ET.Element) -> str:
+    """Get the content of the element as HTML, escaping Atom plain text."""
+    if elem.tag.startswith(ATOM) and elem.get('type', 'text') in (
+            'text', 'text/plain'):
+        return html.escape(_text(elem), quote=False)
+    return _text(elem)
+
+
+def _text(elem: ET.Element) -> str:
+    """Get the content of the element, as markup if it is Atom XHTML."""
+    if elem.get('type') != 'xhtml':
+        return (elem.text or '').strip()
+    for child in elem.iter():
+        child.tag = child.tag.split('}')[-1]
+    return ''.join(ET.tostring(child, encoding='unicode') for child in elem)
+
+
+def compact_entry(entry: dict, h: int = None,
+                  rendered: Dict[Tuple[int, int], str] = None
+                  ) -> FeedParserDict:
+    date = entry.get('published_parsed') or entry.get('updated_parsed')
+    if h is None:
+        h = entry_hash(entry)
+    content = content_hash(entry)
+    html = rendered.get((h, content)) if rendered else None
+    return FeedParserDict(
+        hash=h,
+        content=content,
+        link=entry.get('link'),
+        title=entry.get('title'),
+        published=entry.get('published'),
+        published_parsed=tuple(date) if date else None,
+        html=html or format_entry(entry),
+    )
+
+
+def entry_hash(entry: dict) -> int:
+    """Get a compact identifier for the given entry."""
+    key = entry.get('id') or entry.get('link') or '{}\n{}'.format(
+        entry.get('title'), entry.get('published') or entry.get('updated'))
+    return _hash(key)
+
+
+def content_hash(entry: dict) -> int:
+    """Get a compact hash of the entry data shown in its HTML."""
+    return _hash('\n'.join((
+        entry.get('link') or '', entry.get('title') or '',
+        entry.get('published') or '', _description(entry))))
+
+
+def _hash(text: str) -> int:
+    digest = hashlib.sha1(text.encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+_format_title = '<a href="{}"><h3>{}</h3></a>'.format
+_format_date = '<p>📆 <small><em>{}</em></small></p>'.format
+
+
+def format_entry(entry: dict) -> str:
+    title = entry.get('title')
+    t = _format_title(entry.get('link') or '', title or 'NO TITLE')
+    pub_date = entry.get('published')
+    if pub_date:
+        t += _format_date(pub_date)
+    desc = _description(entry)
+    if desc and desc != title:
+        t += desc
+    return t
+
+
+def _description(entry: dict) -> str:
+    desc = entry.get('description') or ''
+    if not desc and entry.get('content'):
+        for c in entry.get('content'):
+            if c.get('type') == 'text/html':
+                desc += c['value']
+    return desc
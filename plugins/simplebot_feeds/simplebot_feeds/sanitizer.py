@@ -0,0 +1,92 @@
+from html import escape
+from html.parser import HTMLParser
+from typing import List, Optional, Tuple
+from urllib.parse import urlsplit
+
+ELEMENTS = {
+    'a', 'abbr', 'acronym', 'address', 'article', 'aside', 'audio', 'b',
+    'bdi', 'bdo', 'big', 'blockquote', 'br', 'caption', 'center', 'cite',
+    'code', 'col', 'colgroup', 'dd', 'del', 'details', 'dfn', 'div', 'dl',
+    'dt', 'em', 'figcaption', 'figure', 'font', 'footer', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'header', 'hr', 'i', 'img', 'ins', 'kbd', 'li', 'mark',
+    'ol', 'p', 'picture', 'pre', 'q', 's', 'samp', 'section', 'small',
+    'source', 'span', 'strike', 'strong', 'sub', 'summary', 'sup', 'table',
+    'tbody', 'td', 'tfoot', 'th', 'thead', 'time', 'tr', 'tt', 'u', 'ul',
+    'var', 'video', 'wbr',
+}
+VOID_ELEMENTS = {'br', 'col', 'hr', 'img', 'source', 'wbr'}
+# elements dropped together with their content
+HIDDEN_ELEMENTS = {'script', 'style', 'applet'}
+ATTRIBUTES = {
+    'align', 'alt', 'cite', 'colspan', 'controls', 'datetime', 'dir',
+    'height', 'href', 'lang', 'poster', 'rowspan', 'src', 'title', 'type',
+    'width',
+}
+URI_ATTRIBUTES = {'cite', 'href', 'poster', 'src'}
+URI_SCHEMES = {'', 'http', 'https', 'ftp', 'mailto', 'magnet', 'tel', 'xmpp'}
+
+
+class _Sanitizer(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.out: List[str] = []
+        self.open: List[str] = []
+        self.hidden = 0
+
+    def handle_starttag(self, tag: str,
+                        attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag in HIDDEN_ELEMENTS:
+            self.hidden += 1
+        if self.hidden or tag not in ELEMENTS:
+            return
+        self.out.append('<' + tag)
+        for name, value in attrs:
+            if name not in ATTRIBUTES:
+                continue
+            value = (value or '').strip()
+            if name in URI_ATTRIBUTES and urlsplit(
+                    value).scheme.lower() not in URI_SCHEMES:
+                continue
+            self.out.append(' {}="{}"'.format(name, escape(value)))
+        self.out.append('>')
+        if tag not in VOID_ELEMENTS:
+            self.open.append(tag)
+
+    def handle_startendtag(self, tag: str,
+                           attrs: List[Tuple[str, Optional[str]]]) -> None:
+        self.handle_starttag(tag, attrs)
+        if tag in HIDDEN_ELEMENTS:
+            self.hidden -= 1
+        elif tag not in VOID_ELEMENTS and self.open and self.open[-1] == tag:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in HIDDEN_ELEMENTS:
+            self.hidden = max(self.hidden - 1, 0)
+            return
+        if self.hidden or tag not in self.open:
+            return
+        while self.open:
+            opened = self.open.pop()
+            self.out.append('</{}>'.format(opened))
+            if opened == tag:
+                break
+
+    def handle_data(self, data: str) -> None:
+        if not self.hidden:
+            self.out.append(escape(data, quote=False))
+
+    def close(self) -> None:
+        super().close()
+        while self.open:
+            self.out.append('</{}>'.format(self.open.pop()))
+
+
+def sanitize_html(html: str) -> str:
+    """Remove scripts, styles and any markup not in a safe subset of HTML
+    from the given fragment, closing the elements left open.
+    """
+    sanitizer = _Sanitizer()
+    sanitizer.feed(html)
+    sanitizer.close()
+    return ''.join(sanitizer.out)
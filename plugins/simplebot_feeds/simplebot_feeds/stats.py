@@ -0,0 +1,86 @@
+import json
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+#: metrics averaged over the recent checks of a feed
+AVERAGES = ('fetch_time', 'bytes', 'parse_time', 'entries', 'new', 'fanout')
+
+
+class FeedStats:
+    """Rolling per-feed metrics of the checking cycles.
+
+    For every metric in `AVERAGES` the total and an exponentially weighted
+    moving average (giving the last check a weight of `alpha`) are kept, as
+    well as the number of checks and errors, and the status of the last
+    check (the HTTP status code or the name of the error).
+    """
+
+    def __init__(self, alpha: float = 0.2) -> None:
+        self.alpha = alpha
+        self.feeds: Dict[str, dict] = {}
+        self.dirty: set = set()
+        self.lock = threading.Lock()
+
+    def load(self, rows: Iterable[Tuple[str, dict]]) -> None:
+        with self.lock:
+            for url, data in rows:
+                self.feeds[url] = data
+
+    def record(self, url: str, status, **metrics: Optional[float]) -> None:
+        """Add the result of checking a feed, metrics that are None or not
+        given are not updated.
+        """
+        with self.lock:
+            s = self.feeds.get(url)
+            if s is None:
+                s = self.feeds[url] = dict(checks=0, errors=0)
+            s['checks'] += 1
+            if not isinstance(status, int) or status >= 400:
+                s['errors'] += 1
+            s['status'] = status
+            s['checked'] = time.time()
+            for key in AVERAGES:
+                value = metrics.get(key)
+                if value is None:
+                    continue
+                s['total_' + key] = s.get('total_' + key, 0) + value
+                avg = s.get('avg_' + key)
+                s['avg_' + key] = value if avg is None else (
+                    avg + self.alpha * (value - avg))
+            self.dirty.add(url)
+
+    def retain(self, urls: Iterable[str]) -> None:
+        """Forget the metrics of the feeds not in `urls`."""
+        urls = set(urls)
+        with self.lock:
+            for url in list(self.feeds):
+                if url not in urls:
+                    del self.feeds[url]
+                    self.dirty.discard(url)
+
+    def pop_dirty(self) -> List[Tuple[str, dict]]:
+        """Get the metrics updated since the last call."""
+        with self.lock:
+            rows = [(url, dict(self.feeds[url])) for url in self.dirty]
+            self.dirty.clear()
+        return rows
+
+    def top(self, count: int, key: str = 'fetch_time'
+            ) -> List[Tuple[str, dict]]:
+        """Get the `count` feeds with the highest `key` metric, either one of
+        `AVERAGES` (compared by average) or `checks`/`errors`.
+        """
+        if key in AVERAGES:
+            key = 'avg_' + key
+        with self.lock:
+            rows = [(url, dict(s)) for url, s in self.feeds.items()]
+        rows.sort(key=lambda row: row[1].get(key) or 0, reverse=True)
+        return rows[:count]
+
+    def dump(self) -> str:
+        """Get all the metrics as a JSON document."""
+        with self.lock:
+            return json.dumps(
+                dict(time=time.time(), feeds=self.feeds), indent=1,
+                sort_keys=True)
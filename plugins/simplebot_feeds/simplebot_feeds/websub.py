@@ -0,0 +1,127 @@
+import hmac
+import secrets
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from .fetcher import Response
+
+#: (feed url, topic, secret) of a subscription
+Subscription = Tuple[str, str, str]
+
+
+class WebSubServer(ThreadingHTTPServer):
+    """Receive the WebSub hub callbacks at `/<token>`.
+
+    `get_subscription(token)` returns the subscription with the given
+    callback token, or None if there is no such subscription,
+    `verified(token, lease_seconds)` is called when a hub confirms a
+    subscription (with lease 0 if it denied it) and `pushed(feed,
+    response)` is called, in the server thread, with every authenticated
+    content distribution request.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int],
+                 get_subscription: Callable[[str], Optional[Subscription]],
+                 verified: Callable[[str, int], None],
+                 pushed: Callable[[str, Response], None],
+                 max_size: int = 1024**2*10) -> None:
+        super().__init__(address, CallbackHandler)
+        self.get_subscription = get_subscription
+        self.verified = verified
+        self.pushed = pushed
+        self.max_size = max_size
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    server: WebSubServer
+
+    def do_GET(self) -> None:
+        """Verification of intent."""
+        url = urlparse(self.path)
+        token = url.path.strip('/')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        mode = query.get('hub.mode')
+        challenge = query.get('hub.challenge', '')
+        sub = self.server.get_subscription(token)
+        if sub is not None and query.get('hub.topic') != sub[1]:
+            self._reply(404)
+        elif mode == 'subscribe' and sub is not None:
+            try:
+                lease = int(query.get('hub.lease_seconds') or 0)
+            except ValueError:
+                lease = 0
+            self.server.verified(token, lease)
+            self._reply(200, challenge.encode())
+        elif mode == 'unsubscribe' and sub is None:
+            self._reply(200, challenge.encode())
+        elif mode == 'denied':
+            if sub is not None:
+                self.server.verified(token, 0)
+            self._reply(200)
+        else:
+            self._reply(404)
+
+    def do_POST(self) -> None:
+        """Content distribution."""
+        sub = self.server.get_subscription(urlparse(self.path).path.strip('/'))
+        if sub is None:
+            self._reply(410)  # tells the hub to drop the subscription
+            return
+        try:
+            size = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self._reply(411)
+            return
+        if size > self.server.max_size:
+            self._reply(413)
+            return
+        body = self.rfile.read(size)
+        # content with an invalid signature must be ignored, but still
+        # acknowledged so a forger can't tell
+        if check_signature(sub[2], body, self.headers.get('X-Hub-Signature')):
+            headers = {k.lower(): v for k, v in self.headers.items()}
+            self.server.pushed(sub[0], Response(sub[1], 200, headers, body))
+        self._reply(202)
+
+    def _reply(self, status: int, body: bytes = b'') -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def check_signature(secret: str, body: bytes, signature: Optional[str]
+                    ) -> bool:
+    """Check the `X-Hub-Signature` of the given content."""
+    method, _, digest = (signature or '').partition('=')
+    if method not in ('sha1', 'sha256', 'sha384', 'sha512'):
+        return False
+    expected = hmac.new(secret.encode(), body, method).hexdigest()
+    return hmac.compare_digest(expected, digest)
+
+
+def new_token() -> str:
+    return secrets.token_hex(20)
+
+
+def subscribe(hub: str, topic: str, callback: str, secret: str,
+              lease_seconds: int, timeout: float = 30,
+              session: requests.Session = None) -> None:
+    """Ask the hub to push the topic updates to the callback URL, the hub
+    confirms the subscription later requesting the callback.
+    """
+    resp = (session or requests).post(hub, timeout=timeout, data={
+        'hub.mode': 'subscribe',
+        'hub.topic': topic,
+        'hub.callback': callback,
+        'hub.secret': secret,
+        'hub.lease_seconds': lease_seconds,
+    })
+    resp.raise_for_status()
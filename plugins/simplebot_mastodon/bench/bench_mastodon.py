@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Benchmark the Mastodon bridge against local fake Mastodon instances.
+
+Example: python bench/bench_mastodon.py --instances 4 --users 50 --cycles 5
+
+The bot, with a stub DeltaBot, logs in all the users with /m_login and
+then the real polling loop (_listen_to_mastodon) runs in the background.
+Before every cycle the fake instances publish new toots, notifications and
+direct messages for every user and all the accounts are made due; the
+cycle ends once all of them were polled again. For every cycle it reports
+wall time, API requests (total, per account and rate limited), CPU time
+spent rendering toots and messages sent to the chats. The first cycle
+catches up with a backlog of toots published while the bot was down.
+
+Then some commands are run twice for a few accounts, reporting the API
+requests and time per command, the second run shows the effect of the
+caches.
+
+With --streaming the accounts receive their toots through user streams
+instead, a cycle then ends when all the published events were processed.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simplebot_mastodon  # noqa
+from fake_server import add_arguments, from_args  # noqa
+
+
+class StubChat:
+    """A Delta Chat group, counting the messages sent to it."""
+    sent = 0
+    lock = threading.Lock()
+
+    def __init__(self, bot: 'StubBot', gid: int, title: str) -> None:
+        self.bot = bot
+        self.id = gid
+        self.title = title
+
+    def send_text(self, text: str) -> None:
+        with StubChat.lock:
+            StubChat.sent += 1
+
+    def set_profile_image(self, path: str) -> None:
+        pass
+
+    def remove_contact(self, contact) -> None:
+        pass
+
+    def get_contacts(self) -> list:
+        return [self.bot.self_contact]
+
+
+class StubBot:
+    """The parts of DeltaBot used by the bridge."""
+
+    def __init__(self, db_path: str, settings: dict) -> None:
+        self.account = SimpleNamespace(db_path=db_path)
+        self.logger = logging.getLogger('bench')
+        self.settings = settings
+        self.self_contact = SimpleNamespace(addr='bot@example.com')
+        self.chats: dict = {}
+
+    def get(self, key: str, default=None, scope: str = 'global'):
+        return self.settings.get(key, default)
+
+    def set(self, key: str, value, scope: str = 'global') -> None:
+        self.settings[key] = value
+
+    def create_group(self, title: str, members: list) -> StubChat:
+        chat = StubChat(self, len(self.chats) + 100, title)
+        self.chats[chat.id] = chat
+        return chat
+
+    def get_chat(self, gid) -> StubChat:
+        if gid not in self.chats:
+            self.chats[gid] = StubChat(self, gid, str(gid))
+        return self.chats[gid]
+
+
+class StubMessage:
+    def __init__(self, chat: StubChat, addr: str, text: str = '') -> None:
+        self.chat = chat
+        self.text = text
+        self.filename = None
+        self.sender = SimpleNamespace(addr=addr)
+
+    def get_sender_contact(self) -> SimpleNamespace:
+        return self.sender
+
+
+class CountingReplies:
+    """Replace Replies to count the messages instead of sending them."""
+
+    def __init__(self) -> None:
+        self.messages: list = []
+
+    def add(self, **kwargs) -> None:
+        self.messages.append(kwargs)
+
+
+class RenderTimer:
+    """Wrap _toots2text to measure the CPU time spent rendering toots."""
+
+    def __init__(self, func) -> None:
+        self.func = func
+        self.cpu = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs) -> list:
+        start = time.thread_time()
+        texts = list(self.func(*args, **kwargs))
+        cpu = time.thread_time() - start
+        with self.lock:
+            self.cpu += cpu
+        return texts
+
+
+class EventCounter:
+    """Wrap a stream event handler to count the processed events."""
+
+    def __init__(self, func) -> None:
+        self.func = func
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs) -> None:
+        try:
+            self.func(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.count += 1
+
+
+def wait_polled(since: float, timeout: float) -> bool:
+    """Wait until all the accounts were polled after `since`."""
+    db = simplebot_mastodon.db
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with db.lock:
+            due = db.db.execute(
+                'SELECT COUNT(*) FROM accounts WHERE next_poll<=?',
+                (since,)).fetchone()[0]
+        if not due:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def wait_streamed(counters: list, expected: int, timeout: float) -> bool:
+    """Wait until the expected stream events were processed."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if sum(c.count for c in counters) >= expected:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def run_command(func, **kwargs) -> tuple:
+    replies = CountingReplies()
+    start = time.perf_counter()
+    func(replies=replies, **kwargs)
+    return time.perf_counter() - start, replies
+
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(argparser)
+    argparser.add_argument('--cycles', type=int, default=3)
+    argparser.add_argument('--backlog', type=int, default=100,
+                           help='toots published before the first cycle')
+    argparser.add_argument('--toots', type=int, default=5,
+                           help='new toots per user and cycle')
+    argparser.add_argument('--notifications', type=int, default=2,
+                           help='new notifications per user and cycle')
+    argparser.add_argument('--dms', type=int, default=1,
+                           help='new direct messages per user and cycle')
+    argparser.add_argument('--instance-workers', type=int, default=4)
+    argparser.add_argument('--catchup-pages', type=int, default=4)
+    argparser.add_argument('--digest', type=int, default=1)
+    argparser.add_argument('--streaming', action='store_true')
+    argparser.add_argument('--commands', type=int, default=5,
+                           help='accounts the commands are run for')
+    argparser.add_argument('--timeout', type=float, default=300)
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    server = from_args(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_mastodon_')
+    settings = {
+        # accounts are made due by the benchmark, not by the scheduler
+        'delay': '3600',
+        'min_delay': '0.05',
+        'max_delay': '7200',
+        'instance_workers': str(args.instance_workers),
+        'catchup_pages': str(args.catchup_pages),
+        'digest': str(args.digest),
+        'streaming': '1' if args.streaming else '0',
+    }
+    bot = StubBot(os.path.join(tmpdir, 'bot.db'), settings)
+    sm = simplebot_mastodon
+    # the fake instances are served over plain HTTP
+    sm._normalize_url = lambda url: url.rstrip('/')
+    sm._toots2text = render = RenderTimer(sm._toots2text)
+    sm._on_home_toot = on_toot = EventCounter(sm._on_home_toot)
+    sm._on_notification = on_notif = EventCounter(sm._on_notification)
+    sm.deltabot_init(bot)
+    db = sm.db
+
+    # a toot for every user so the accounts start with a home cursor
+    server.publish(1, 0, 0)
+    server.reset_stats()
+    start = time.perf_counter()
+    n = 0
+    for url in server.instance_urls():
+        for i in range(args.users):
+            addr = 'user{}@example.org'.format(n)
+            sm.m_login(bot, '{} user{}@example.com password'.format(url, i),
+                       StubMessage(bot.get_chat(addr), addr),
+                       CountingReplies())
+            n += 1
+    accounts = db.get_accounts()
+    print('{} accounts on {} instances logged in in {:.2f}s with {} API'
+          ' requests'.format(len(accounts), args.instances,
+                             time.perf_counter() - start, server.requests))
+
+    # toots published while the bot was down
+    for _ in range(args.backlog // max(args.toots, 1)):
+        server.publish(args.toots, 0, 0)
+    sm.deltabot_start(bot)
+    print('cycle    wall  requests  req/acc  limited  render(cpu)  messages'
+          '  streamed')
+    for cycle in range(1, args.cycles + 1):
+        server.reset_stats()
+        StubChat.sent = 0
+        render.cpu = 0.0
+        on_toot.count = on_notif.count = 0
+        start_time = time.time()
+        start = time.perf_counter()
+        if cycle > 1 or not args.backlog:
+            server.publish(args.toots, args.notifications, args.dms)
+        if server.stream_events and not wait_streamed(
+                [on_toot, on_notif], server.stream_events, args.timeout):
+            print('cycle {}: timeout'.format(cycle))
+        with db.lock, db.db:
+            db.db.execute('UPDATE accounts SET next_poll=0')
+        if not wait_polled(start_time, args.timeout):
+            print('cycle {}: timeout'.format(cycle))
+        wall = time.perf_counter() - start
+        print('{:>5} {:>7.2f} {:>9} {:>8.1f} {:>8} {:>12.3f} {:>9} {:>9}'
+              .format(cycle, wall, server.requests,
+                      server.requests / len(accounts), server.rate_limited,
+                      render.cpu, StubChat.sent, server.stream_events))
+
+    print('\ncommand            run  requests     ms  replies')
+    for acc in accounts[:args.commands]:
+        chat = bot.get_chat(acc['home'])
+        instance = server.hosts[acc['api_url'].split('//')[1].split(':')[0]]
+        pchats = [p['contact'] for p in db.get_pchats(acc['id'])]
+        others = [a['acct'] for a in instance.accounts.values()
+                  if a['acct'] != acc['accname']]
+        other = next((a for a in others if a not in pchats), others[0])
+        toot_id = instance.homes[next(
+            i for i, a in instance.accounts.items()
+            if a['acct'] == acc['accname'])][-1]['id']
+        commands = [
+            ('m_profile', sm.m_profile, dict(payload=other)),
+            ('m_follow', sm.m_follow, dict(payload=other)),
+            ('m_dm', sm.m_dm, dict(bot=bot, payload=other)),
+            ('m_search', sm.m_search, dict(payload=other)),
+            ('m_reply', sm.m_reply, dict(
+                bot=bot, payload='{} {} hi'.format(acc['id'], toot_id))),
+            ('m_star', sm.m_star, dict(args=[str(acc['id']), toot_id])),
+            ('toot', sm.filter_messages, dict(bot=bot)),
+        ]
+        for run in (1, 2):
+            for name, func, kwargs in commands:
+                message = StubMessage(chat, acc['addr'], 'Hello!')
+                server.reset_stats()
+                wall, replies = run_command(func, message=message, **kwargs)
+                print('{:<16} {:>5} {:>9} {:>6.1f} {:>8}'.format(
+                    name, run, server.requests, wall * 1000,
+                    len(replies.messages)))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
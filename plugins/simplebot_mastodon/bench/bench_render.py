@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the toot HTML-to-text renderer.
+
+Every toot in fixtures/toots.json is rendered and compared with its
+expected (golden) text, then the time per toot is reported for the
+single-pass renderer and, if beautifulsoup4 is installed, for the
+BeautifulSoup implementation it replaced.
+
+Example: python bench/bench_render.py --rounds 2000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'bench', 'fixtures', 'toots.json')
+# import the module directly, without the plugin's dependencies
+sys.path.insert(0, os.path.join(ROOT, 'simplebot_mastodon'))
+
+from render import toot2text  # noqa
+
+
+def bs4_toot2text(content: str, mentions: dict) -> str:
+    """The previous implementation, walking a BeautifulSoup tree."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, 'html.parser')
+    if mentions:
+        for a in soup('a', class_='u-url'):
+            name = mentions.get(a['href'])
+            if name:
+                a.string = name
+    for br in soup('br'):
+        br.replace_with('\n')
+    for p in soup('p'):
+        p.replace_with(p.get_text()+'\n\n')
+    return soup.get_text()
+
+
+def check(toots: list) -> int:
+    """Compare the renderer output with the golden texts."""
+    failures = 0
+    for n, toot in enumerate(toots):
+        text = toot2text(toot['content'], toot['mentions'])
+        if text != toot['text']:
+            failures += 1
+            print('FAIL #{}:\n  expected: {!r}\n  got:      {!r}'.format(
+                n, toot['text'], text))
+    return failures
+
+
+def bench(func, toots: list, rounds: int) -> float:
+    """Microseconds per toot."""
+    def run() -> None:
+        for toot in toots:
+            func(toot['content'], toot['mentions'])
+    return min(timeit.repeat(run, number=rounds, repeat=3)) / (
+        rounds * len(toots)) * 1e6
+
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--rounds', type=int, default=1000)
+    args = argparser.parse_args()
+
+    with open(FIXTURES) as fh:
+        toots = json.load(fh)
+    failures = check(toots)
+    print('{}/{} golden outputs match'.format(
+        len(toots) - failures, len(toots)))
+
+    print('single pass:   {:8.1f} µs/toot'.format(
+        bench(toot2text, toots, args.rounds)))
+    try:
+        import bs4  # noqa
+    except ImportError:
+        print('BeautifulSoup: not installed')
+    else:
+        print('BeautifulSoup: {:8.1f} µs/toot'.format(
+            bench(bs4_toot2text, toots, args.rounds)))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+"""Local stand-in for one or more Mastodon instances.
+
+Instance `n` is served at `http://127.0.0.<n + 1>:<port>`, so they look like
+different hosts to the bot, and has `users` local users that can log in
+as `user<i>@example.com` with the password `password`. The API responses
+are built from the recorded fixtures in fixtures/api.json, the toot
+contents are taken from fixtures/toots.json.
+
+It implements what the bridge uses: app registration and password login,
+the home, local, public and hashtag timelines, notifications, accounts
+(lookup, search, relationships, follow, mute, block), statuses (post,
+reply, favourite, boost, context), media uploads, search, avatars and the
+user stream. Timelines only change when publish() is called, every call
+adds new toots and notifications for every user.
+"""
+import argparse
+import copy
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# a 1x1 PNG image
+AVATAR = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360f8cfc0f01f0005000201e2213b'
+    'e10000000049454e44ae426082')
+
+
+def _load(name: str):
+    with open(os.path.join(FIXTURES, name)) as fh:
+        return json.load(fh)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[
+        :-3] + 'Z'
+
+
+class Instance:
+    """The users, toots and notifications of a fake instance."""
+
+    def __init__(self, server: 'FakeMastodon', n: int, users: int) -> None:
+        self.server = server
+        self.host = '127.0.0.{}'.format(n + 1)
+        self.url = 'http://{}:{}'.format(self.host, server.server_address[1])
+        self.accounts: Dict[str, dict] = {}
+        self.emails: Dict[str, str] = {}
+        # account id -> toots/notifications, oldest first
+        self.homes: Dict[str, List[dict]] = {}
+        self.notifications: Dict[str, List[dict]] = {}
+        self.statuses: Dict[str, dict] = {}
+        self.tags: Dict[str, List[dict]] = {}
+        self.local: List[dict] = []
+        # account id -> queues of the open user streams
+        self.streams: Dict[str, List[queue.Queue]] = {}
+        for i in range(users):
+            acc = self.new_account('user{}'.format(i))
+            self.emails['user{}@example.com'.format(i)] = acc['id']
+
+    def new_account(self, username: str) -> dict:
+        acc = copy.deepcopy(self.server.fixtures['account'])
+        acc['id'] = self.server.new_id()
+        acc['username'] = acc['acct'] = username
+        acc['display_name'] = username.capitalize()
+        acc['url'] = '{}/@{}'.format(self.url, username)
+        acc['avatar'] = acc['avatar_static'] = '{}/avatars/{}.png'.format(
+            self.url, acc['id'])
+        self.accounts[acc['id']] = acc
+        self.homes[acc['id']] = []
+        self.notifications[acc['id']] = []
+        return acc
+
+    def find_account(self, acct: str) -> Optional[dict]:
+        acct = acct.lstrip('@').split('@')[0].lower()
+        for acc in self.accounts.values():
+            if acc['acct'] == acct:
+                return acc
+        return None
+
+    def new_status(self, author: dict, content: str = None,
+                   mentions: List[dict] = (), visibility: str = 'public',
+                   in_reply_to: dict = None, media: List[dict] = ()) -> dict:
+        status = copy.deepcopy(self.server.fixtures['status'])
+        status['id'] = self.server.new_id()
+        status['created_at'] = _now()
+        status['account'] = author
+        status['uri'] = status['url'] = '{}/@{}/{}'.format(
+            self.url, author['username'], status['id'])
+        status['visibility'] = visibility
+        status['media_attachments'] = list(media)
+        if content is None:
+            toot = random.choice(self.server.toots)
+            content = toot['content']
+            mentions = mentions or [
+                {'id': self.server.new_id(), 'url': url,
+                 'username': name.lstrip('@').split('@')[0],
+                 'acct': name.lstrip('@')}
+                for url, name in toot['mentions'].items()]
+        status['content'] = content
+        status['mentions'] = [{key: m[key] for key in (
+            'id', 'username', 'url', 'acct')} for m in mentions]
+        if in_reply_to:
+            status['in_reply_to_id'] = in_reply_to['id']
+            status['in_reply_to_account_id'] = in_reply_to['account']['id']
+        self.statuses[status['id']] = status
+        if visibility == 'public':
+            self.local.append(status)
+            for tag in re.findall(r'#(\w+)', content):
+                self.tags.setdefault(tag.lower(), []).append(status)
+        return status
+
+    def new_notification(self, acc_id: str, ntype: str, account: dict,
+                         status: dict = None) -> dict:
+        notif = copy.deepcopy(self.server.fixtures['notification'])
+        notif['id'] = self.server.new_id()
+        notif['created_at'] = _now()
+        notif['type'] = ntype
+        notif['account'] = account
+        notif['status'] = status
+        self.notifications[acc_id].append(notif)
+        self.push(acc_id, 'notification', notif)
+        return notif
+
+    def add_to_home(self, acc_id: str, status: dict) -> None:
+        self.homes[acc_id].append(status)
+        self.push(acc_id, 'update', status)
+
+    def push(self, acc_id: str, event: str, payload: dict) -> None:
+        for q in self.streams.get(acc_id, ()):
+            q.put((event, payload))
+            self.server.count_stream_event()
+
+    def publish(self, toots: int, notifications: int, dms: int) -> None:
+        users = list(self.accounts.values())
+        for acc in users:
+            others = [u for u in users if u is not acc] or [acc]
+            for _ in range(toots):
+                self.add_to_home(acc['id'],
+                                 self.new_status(random.choice(others)))
+            own = self.new_status(acc)
+            for _ in range(notifications):
+                ntype = random.choice(('favourite', 'reblog', 'follow',
+                                       'mention'))
+                author = random.choice(others)
+                if ntype == 'mention':
+                    status = self.new_status(author, mentions=[acc])
+                elif ntype == 'follow':
+                    status = None
+                else:
+                    status = own
+                self.new_notification(acc['id'], ntype, author, status)
+            for _ in range(dms):
+                author = random.choice(others)
+                self.new_notification(
+                    acc['id'], 'mention', author, self.new_status(
+                        author, mentions=[acc], visibility='direct'))
+
+    def relationship(self, acc_id: str, target_id: str) -> dict:
+        rels = self.server.relationships
+        key = (acc_id, target_id)
+        if key not in rels:
+            rels[key] = copy.deepcopy(self.server.fixtures['relationship'])
+            rels[key]['id'] = target_id
+        return rels[key]
+
+
+class FakeMastodon(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port: int = 0, instances: int = 1, users: int = 10,
+                 latency: float = 0.0, rate_limit: int = 300,
+                 rate_window: float = 300) -> None:
+        # bind to all addresses so instances can be spread over
+        # 127.0.0.0/8 and look like different hosts to the bot
+        super().__init__(('0.0.0.0', port), MastodonHandler)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.fixtures = _load('api.json')
+        self.toots = _load('toots.json')
+        self.ids = itertools.count(int(time.time() * 1000) << 16)
+        self.lock = threading.RLock()
+        self.tokens: Dict[str, str] = {}  # access token -> account id
+        # access token -> (requests left, window reset)
+        self.limits: Dict[str, list] = {}
+        self.relationships: Dict[tuple, dict] = {}
+        self.instances = [Instance(self, n, users) for n in range(instances)]
+        self.hosts = {i.host: i for i in self.instances}
+        self.reset_stats()
+
+    def new_id(self) -> str:
+        with self.lock:
+            return str(next(self.ids))
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.requests = 0
+            self.endpoints: Counter = Counter()
+            self.rate_limited = 0
+            self.stream_events = 0
+
+    def count(self, endpoint: str, status: int) -> None:
+        with self.lock:
+            self.requests += 1
+            self.endpoints[endpoint] += 1
+            if status == 429:
+                self.rate_limited += 1
+
+    def count_stream_event(self) -> None:
+        with self.lock:
+            self.stream_events += 1
+
+    def take_request(self, token: str) -> tuple:
+        """Count a request against the rate limit of the access token,
+        returns (limited, remaining, reset).
+        """
+        now = time.time()
+        with self.lock:
+            limit = self.limits.get(token)
+            if not limit or limit[1] <= now:
+                limit = self.limits[token] = [
+                    self.rate_limit, now + self.rate_window]
+            limited = limit[0] <= 0
+            if not limited:
+                limit[0] -= 1
+            return limited, limit[0], limit[1]
+
+    def instance_urls(self) -> List[str]:
+        return [i.url for i in self.instances]
+
+    def publish(self, toots: int = 5, notifications: int = 2,
+                dms: int = 1) -> None:
+        """Add new toots to the home timelines of all the users and new
+        notifications and direct messages for them.
+        """
+        for instance in self.instances:
+            with self.lock:
+                instance.publish(toots, notifications, dms)
+
+
+class MastodonHandler(BaseHTTPRequestHandler):
+    server: FakeMastodon
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    ROUTES = [
+        ('GET', r'/api/v1/instance/?', 'instance', False),
+        ('POST', r'/api/v1/apps', 'create_app', False),
+        ('POST', r'/oauth/token', 'token', False),
+        ('GET', r'/avatars/\d+\.png', 'avatar', False),
+        ('GET', r'/api/v1/accounts/verify_credentials', 'me', True),
+        ('PATCH', r'/api/v1/accounts/update_credentials', 'update', True),
+        ('GET', r'/api/v1/accounts/search', 'account_search', True),
+        ('GET', r'/api/v1/accounts/relationships', 'relationships', True),
+        ('GET', r'/api/v1/accounts/(\d+)', 'account', True),
+        ('GET', r'/api/v1/accounts/(\d+)/statuses', 'account_statuses',
+         True),
+        ('POST', r'/api/v1/accounts/(\d+)/(follow|unfollow|mute|unmute|'
+         r'block|unblock)', 'account_action', True),
+        ('GET', r'/api/v1/timelines/home', 'home', True),
+        ('GET', r'/api/v1/timelines/public', 'public', True),
+        ('GET', r'/api/v1/timelines/tag/(\w+)', 'tag', True),
+        ('GET', r'/api/v1/notifications', 'notifications', True),
+        ('GET', r'/api/v1/statuses/(\d+)', 'status', True),
+        ('GET', r'/api/v1/statuses/(\d+)/context', 'context', True),
+        ('POST', r'/api/v1/statuses/(\d+)/(favourite|reblog)',
+         'status_action', True),
+        ('POST', r'/api/v1/statuses', 'status_post', True),
+        ('POST', r'/api/v[12]/media', 'media', True),
+        ('GET', r'/api/v2/search', 'search', True),
+        ('GET', r'/api/v1/streaming/user', 'stream', True),
+    ]
+    ROUTES = [(method, re.compile(path + '$'), name, auth)
+              for method, path, name, auth in ROUTES]
+
+    def do_GET(self) -> None:
+        self._dispatch('GET')
+
+    def do_POST(self) -> None:
+        self._dispatch('POST')
+
+    def do_PATCH(self) -> None:
+        self._dispatch('PATCH')
+
+    def _dispatch(self, method: str) -> None:
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        self.query = parse_qs(url.query)
+        self.form = self._read_form()
+        host = (self.headers.get('Host') or '').split(':')[0]
+        self.instance = self.server.hosts.get(host)
+        self.user = self.limit = None
+        for route_method, path, name, auth in self.ROUTES:
+            match = path.match(url.path)
+            if route_method != method or not match:
+                continue
+            if self.instance is None:
+                return self._reply(name, 404, {'error': 'Unknown host'})
+            if auth:
+                token = (self.headers.get('Authorization') or '')[7:]
+                acc_id = self.server.tokens.get(token)
+                if acc_id not in self.instance.accounts:
+                    return self._reply(name, 401, {
+                        'error': 'The access token is invalid'})
+                self.user = self.instance.accounts[acc_id]
+                self.limit = self.server.take_request(token)
+                if self.limit[0]:
+                    return self._reply(name, 429, {
+                        'error': 'Too many requests'})
+            return getattr(self, 'api_' + name)(name, *match.groups())
+        self._reply(url.path, 404, {'error': 'Record not found'})
+
+    def _read_form(self) -> dict:
+        size = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(size) if size else b''
+        ctype = self.headers.get('Content-Type') or ''
+        if ctype.startswith('application/x-www-form-urlencoded'):
+            return parse_qs(body.decode())
+        if ctype.startswith('application/json') and body:
+            return {k: v if isinstance(v, list) else [v]
+                    for k, v in json.loads(body).items()}
+        return {}
+
+    def _arg(self, name: str, default=None):
+        values = self.query.get(name) or self.form.get(name)
+        return values[0] if values else default
+
+    def _reply(self, endpoint: str, status: int, data=None,
+               body: bytes = None, ctype: str = 'application/json') -> None:
+        self.server.count(endpoint, status)
+        if body is None:
+            body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        if self.limit:
+            _, remaining, reset = self.limit
+            self.send_header('X-RateLimit-Limit', str(self.server.rate_limit))
+            self.send_header('X-RateLimit-Remaining', str(remaining))
+            self.send_header('X-RateLimit-Reset', datetime.fromtimestamp(
+                reset, timezone.utc).isoformat())
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _page(self, items: List[dict]) -> List[dict]:
+        """Paginate items sorted oldest first as Mastodon does."""
+        limit = min(int(self._arg('limit', 20)), 40)
+        max_id = self._arg('max_id')
+        since_id = self._arg('since_id')
+        min_id = self._arg('min_id')
+        with self.server.lock:
+            items = [i for i in items
+                     if (not max_id or int(i['id']) < int(max_id))
+                     and (not since_id or int(i['id']) > int(since_id))
+                     and (not min_id or int(i['id']) > int(min_id))]
+        if min_id:
+            items = items[:limit]
+        else:
+            items = items[-limit:]
+        return items[::-1]
+
+    # ==== apps and login =====
+
+    def api_instance(self, name: str) -> None:
+        data = copy.deepcopy(self.server.fixtures['instance'])
+        data['uri'] = self.instance.host
+        data['urls']['streaming_api'] = self.instance.url.replace(
+            'http://', 'ws://')
+        self._reply(name, 200, data)
+
+    def api_create_app(self, name: str) -> None:
+        data = copy.deepcopy(self.server.fixtures['app'])
+        data['id'] = self.server.new_id()
+        data['name'] = self._arg('client_name', data['name'])
+        self._reply(name, 200, data)
+
+    def api_token(self, name: str) -> None:
+        acc_id = self.instance.emails.get(self._arg('username', ''))
+        if acc_id is None or self._arg('password') != 'password':
+            return self._reply(name, 400, {'error': 'invalid_grant'})
+        data = copy.deepcopy(self.server.fixtures['token'])
+        data['access_token'] = 'token-{}'.format(self.server.new_id())
+        data['created_at'] = int(time.time())
+        self.server.tokens[data['access_token']] = acc_id
+        self._reply(name, 200, data)
+
+    def api_avatar(self, name: str) -> None:
+        self._reply(name, 200, body=AVATAR, ctype='image/png')
+
+    # ==== accounts =====
+
+    def api_me(self, name: str) -> None:
+        self._reply(name, 200, self.user)
+
+    def api_update(self, name: str) -> None:
+        with self.server.lock:
+            if self._arg('note') is not None:
+                self.user['note'] = '<p>{}</p>'.format(self._arg('note'))
+        self._reply(name, 200, self.user)
+
+    def api_account_search(self, name: str) -> None:
+        acc = self.instance.find_account(self._arg('q', ''))
+        self._reply(name, 200, [acc] if acc else [])
+
+    def api_relationships(self, name: str) -> None:
+        ids = self.query.get('id[]') or self.query.get('id') or []
+        with self.server.lock:
+            rels = [self.instance.relationship(self.user['id'], i)
+                    for i in ids]
+        self._reply(name, 200, rels)
+
+    def api_account(self, name: str, acc_id: str) -> None:
+        acc = self.instance.accounts.get(acc_id)
+        if acc is None:
+            return self._reply(name, 404, {'error': 'Record not found'})
+        self._reply(name, 200, acc)
+
+    def api_account_statuses(self, name: str, acc_id: str) -> None:
+        with self.server.lock:
+            items = [s for s in self.instance.local
+                     if s['account']['id'] == acc_id]
+        self._reply(name, 200, self._page(items))
+
+    def api_account_action(self, name: str, acc_id: str,
+                           action: str) -> None:
+        if acc_id not in self.instance.accounts:
+            return self._reply(name, 404, {'error': 'Record not found'})
+        with self.server.lock:
+            rel = self.instance.relationship(self.user['id'], acc_id)
+            field = {'follow': 'following', 'mute': 'muting',
+                     'block': 'blocking'}[action.replace('un', '')]
+            rel[field] = not action.startswith('un')
+        self._reply(name, 200, rel)
+
+    # ==== timelines =====
+
+    def api_home(self, name: str) -> None:
+        self._reply(name, 200, self._page(self.instance.homes[
+            self.user['id']]))
+
+    def api_public(self, name: str) -> None:
+        self._reply(name, 200, self._page(self.instance.local))
+
+    def api_tag(self, name: str, tag: str) -> None:
+        self._reply(name, 200, self._page(
+            self.instance.tags.get(tag.lower(), [])))
+
+    def api_notifications(self, name: str) -> None:
+        self._reply(name, 200, self._page(self.instance.notifications[
+            self.user['id']]))
+
+    # ==== statuses =====
+
+    def api_status(self, name: str, status_id: str) -> None:
+        status = self.instance.statuses.get(status_id)
+        if status is None:
+            return self._reply(name, 404, {'error': 'Record not found'})
+        self._reply(name, 200, status)
+
+    def api_context(self, name: str, status_id: str) -> None:
+        status = self.instance.statuses.get(status_id)
+        if status is None:
+            return self._reply(name, 404, {'error': 'Record not found'})
+        ancestors = []
+        with self.server.lock:
+            while status['in_reply_to_id'] in self.instance.statuses:
+                status = self.instance.statuses[status['in_reply_to_id']]
+                ancestors.insert(0, status)
+        self._reply(name, 200, {'ancestors': ancestors, 'descendants': []})
+
+    def api_status_action(self, name: str, status_id: str,
+                          action: str) -> None:
+        status = self.instance.statuses.get(status_id)
+        if status is None:
+            return self._reply(name, 404, {'error': 'Record not found'})
+        with self.server.lock:
+            status[{'favourite': 'favourited',
+                    'reblog': 'reblogged'}[action]] = True
+            author = status['account']['id']
+            if author in self.instance.accounts:
+                self.instance.new_notification(
+                    author, action, self.user, status)
+        self._reply(name, 200, status)
+
+    def api_status_post(self, name: str) -> None:
+        text = self._arg('status', '')
+        media = [{'id': i, 'type': 'unknown',
+                  'url': '{}/media/{}'.format(self.instance.url, i)}
+                 for i in self.form.get('media_ids[]', [])]
+        with self.server.lock:
+            reply_to = self.instance.statuses.get(self._arg('in_reply_to_id'))
+            mentions = [a for a in map(self.instance.find_account,
+                                       re.findall(r'@([\w@.]+)', text)) if a]
+            status = self.instance.new_status(
+                self.user, '<p>{}</p>'.format(text), mentions,
+                self._arg('visibility') or 'public', reply_to, media)
+            for acc in mentions:
+                self.instance.new_notification(
+                    acc['id'], 'mention', self.user, status)
+        self._reply(name, 200, status)
+
+    def api_media(self, name: str) -> None:
+        data = copy.deepcopy(self.server.fixtures['media'])
+        data['id'] = self.server.new_id()
+        data['url'] = '{}/media/{}'.format(self.instance.url, data['id'])
+        self._reply(name, 200, data)
+
+    def api_search(self, name: str) -> None:
+        q = self._arg('q', '')
+        acc = self.instance.find_account(q)
+        tags = [{'name': t, 'url': '{}/tags/{}'.format(self.instance.url, t),
+                 'history': []}
+                for t in self.instance.tags if q.lstrip('#').lower() in t]
+        self._reply(name, 200, {'accounts': [acc] if acc else [],
+                                'statuses': [], 'hashtags': tags})
+
+    # ==== streaming =====
+
+    def api_stream(self, name: str) -> None:
+        self.server.count(name, 200)
+        events: queue.Queue = queue.Queue()
+        streams = self.instance.streams.setdefault(self.user['id'], [])
+        with self.server.lock:
+            streams.append(events)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                try:
+                    event, payload = events.get(timeout=15)
+                except queue.Empty:
+                    self.wfile.write(b':thump\n')
+                else:
+                    self.wfile.write('event: {}\ndata: {}\n\n'.format(
+                        event, json.dumps(payload)).encode())
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with self.server.lock:
+                streams.remove(events)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def add_arguments(argparser: argparse.ArgumentParser) -> None:
+    argparser.add_argument('--port', type=int, default=0)
+    argparser.add_argument('--instances', type=int, default=4)
+    argparser.add_argument('--users', type=int, default=25,
+                           help='users per instance')
+    argparser.add_argument('--latency', type=float, default=0.0,
+                           help='seconds to wait before every response')
+    argparser.add_argument('--rate-limit', type=int, default=300,
+                           help='requests allowed per access token and'
+                           ' window')
+    argparser.add_argument('--rate-window', type=float, default=300)
+
+
+def from_args(args: argparse.Namespace) -> FakeMastodon:
+    return FakeMastodon(
+        port=args.port, instances=args.instances, users=args.users,
+        latency=args.latency, rate_limit=args.rate_limit,
+        rate_window=args.rate_window)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(argparser)
+    argparser.add_argument('--publish', type=float, default=60,
+                           help='seconds between new toots, 0 to disable')
+    cli_args = argparser.parse_args()
+    if not cli_args.port:
+        cli_args.port = 8082
+    server = from_args(cli_args)
+    for url in server.instance_urls():
+        print('Instance listening at', url)
+    if cli_args.publish:
+        def _publish() -> None:
+            while True:
+                time.sleep(cli_args.publish)
+                server.publish()
+        threading.Thread(target=_publish, daemon=True).start()
+    server.serve_forever()
@@ -44,7 +44,6 @@ if __name__ == "__main__":
             'simplebot',
             'Mastodon.py',
             'html2text',
-            'beautifulsoup4',
             'requests',
             'pydub',
         ],
@@ -2,22 +2,27 @@
 import os
 import sqlite3
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
-from tempfile import NamedTemporaryFile
-from threading import Thread
-from typing import Any, Generator
+from functools import partial
+from queue import Queue
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, Generator, List, Tuple
 
 import mastodon
 import requests
 import simplebot
-from bs4 import BeautifulSoup
 from deltachat import Chat, Contact, Message
 from html2text import html2text
-from pydub import AudioSegment
+from requests.adapters import HTTPAdapter
 from simplebot import DeltaBot
 from simplebot.bot import Replies
 
+from .avatars import AvatarCache
+from .cache import LRUCache
 from .db import DBManager
+from .render import toot2text
+from .transcode import Transcoder
 
 
 class Visibility(str, Enum):
@@ -34,21 +39,71 @@ v2emoji = {Visibility.DIRECT: '✉', Visibility.PRIVATE: '🔒',
            Visibility.UNLISTED: '🔓', Visibility.PUBLIC: '🌎'}
 TOOT_SEP = '\n\n―――――――――――――――\n\n'
 STRFORMAT = '%Y-%m-%d %H:%M'
+POLL_CALLS = 2  # minimum API requests needed to poll an account
+USER_NOT_FOUND_TTL = 60  # seconds to remember failed user lookups
 db: DBManager
+sessions: LRUCache
+# account id -> id of the logged in Mastodon user
+me_ids: LRUCache
+# (api_url, acct or id) -> Mastodon user, or None if not found
+users: LRUCache
+avatars: AvatarCache
+transcoder: Transcoder
+# posts the voice messages once they are converted
+uploads: ThreadPoolExecutor
+http = requests.Session()
+http.mount('https://', HTTPAdapter(pool_connections=100, pool_maxsize=10))
+http.mount('http://', HTTPAdapter(pool_connections=100, pool_maxsize=10))
+# account id -> user stream handle
+streams: Dict[int, Any] = {}
+stream_queues: List[Queue] = []
+# account id -> lock guarding the account's last_home/last_notif cursors,
+# so items received by both polling and streaming are sent once
+cursor_locks: Dict[int, Lock] = {}
 
 
 @simplebot.hookimpl
 def deltabot_init(bot: DeltaBot) -> None:
-    global db
+    global db, sessions, me_ids, users, avatars, transcoder, uploads
     db = _get_db(bot)
 
     _getdefault(bot, 'delay', '30')
+    _getdefault(bot, 'min_delay', '10')
+    _getdefault(bot, 'max_delay', '300')
+    _getdefault(bot, 'instance_workers', '4')
     _getdefault(bot, 'max_users', '-1')
     _getdefault(bot, 'max_users_instance', '-1')
+    _getdefault(bot, 'catchup_pages', '4')
+    _getdefault(bot, 'page_size', '40')
+    _getdefault(bot, 'digest', '1')
+    _getdefault(bot, 'digest_size', '20000')
+    sessions = LRUCache(int(_getdefault(bot, 'max_sessions', '200')))
+    me_ids = LRUCache(int(_getdefault(bot, 'max_sessions')),
+                      int(_getdefault(bot, 'me_ttl', str(60*60))))
+    users = LRUCache(int(_getdefault(bot, 'user_cache_size', '1000')),
+                     int(_getdefault(bot, 'user_cache_ttl', '600')))
+    _getdefault(bot, 'streaming', '0')
+    _getdefault(bot, 'stream_workers', '2')
+    avatars = AvatarCache(
+        db, os.path.join(os.path.dirname(bot.account.db_path), __name__,
+                         'avatars'), http,
+        int(_getdefault(bot, 'avatar_cache_size', str(1024*1024*20))),
+        int(_getdefault(bot, 'avatar_ttl', str(60*60*24))))
+    workers = int(_getdefault(bot, 'transcode_workers', '2'))
+    transcoder = Transcoder(
+        os.path.join(os.path.dirname(bot.account.db_path), __name__,
+                     'audio'), workers,
+        int(_getdefault(bot, 'transcode_cache_size', str(1024*1024*50))))
+    uploads = ThreadPoolExecutor(max_workers=workers)
 
 
 @simplebot.hookimpl
 def deltabot_start(bot: DeltaBot) -> None:
+    if int(_getdefault(bot, 'streaming')):
+        for _ in range(int(_getdefault(bot, 'stream_workers'))):
+            stream_queues.append(Queue())
+            Thread(target=_process_stream_events,
+                   args=(bot, stream_queues[-1]), daemon=True).start()
     Thread(target=_listen_to_mastodon, args=(bot,), daemon=True).start()
 
 
@@ -59,27 +114,27 @@ def deltabot_member_removed(bot: DeltaBot, chat: Chat, contact: Contact,
     if me == contact or len(chat.get_contacts()) <= 1:
         acc = db.get_account(chat.id)
         if acc:
-            if chat.id in (acc['home'], acc['notif']):
-                _logout(bot, acc, replies)
-            else:
+            if acc['kind'] == 'pchat':
                 db.remove_pchat(chat.id)
+            else:
+                _logout(bot, acc, replies)
 
 
 @simplebot.filter(name=__name__)
-def filter_messages(message: Message, replies: Replies) -> None:
+def filter_messages(bot: DeltaBot, message: Message,
+                    replies: Replies) -> None:
     """Process messages sent to a Mastodon chat.
     """
-    acc = db.get_account_by_home(message.chat.id)
-    if acc:
-        _toot(_get_session(acc), message.text, message.filename)
+    acc = db.get_account(message.chat.id)
+    if not acc:
         return
 
-    pchat = db.get_pchat(message.chat.id)
-    if pchat:
-        acc = db.get_account_by_id(pchat['account'])
-        text = '@{} {}'.format(pchat['contact'], message.text)
-        _toot(_get_session(acc), text, message.filename,
-              visibility=Visibility.DIRECT)
+    if acc['kind'] == 'home':
+        _send_toot(bot, message, replies, acc, message.text)
+    elif acc['kind'] == 'pchat':
+        text = '@{} {}'.format(acc['contact'], message.text)
+        _send_toot(bot, message, replies, acc, text,
+                   visibility=Visibility.DIRECT)
 
 
 @simplebot.command
@@ -99,7 +154,8 @@ def m_login(bot: DeltaBot, payload: str, message: Message, replies: Replies) ->
             text='No more accounts allowed from {}'.format(api_url))
         return
 
-    m = _get_session(dict(api_url=api_url, email=email, password=passwd))
+    token = _log_in(api_url, email, passwd)
+    m = _new_client(api_url, token)
     uname = m.me().acct.lower()
 
     old_user = db.get_account_by_user(uname, api_url)
@@ -118,7 +174,7 @@ def m_login(bot: DeltaBot, payload: str, message: Message, replies: Replies) ->
     ngroup = bot.create_group('Notifications ({})'.format(url), [addr])
 
     db.add_account(email, passwd, api_url, uname, addr, hgroup.id,
-                   ngroup.id, last_home, last_notif)
+                   ngroup.id, last_home, last_notif, token)
 
     hgroup.set_profile_image(MASTODON_LOGO)
     ngroup.set_profile_image(MASTODON_LOGO)
@@ -183,9 +239,8 @@ def m_bio(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='You must provide a biography')
         return
 
-    m = _get_session(acc)
     try:
-        m.account_update_credentials(note=payload)
+        _call(acc, 'account_update_credentials', note=payload)
         replies.add(text='Biography updated')
     except mastodon.MastodonAPIError as err:
         replies.add(text=err.args[-1])
@@ -209,9 +264,8 @@ def m_avatar(message: Message, replies: Replies) -> None:
             text='You must send an avatar attached to your messagee')
         return
 
-    m = _get_session(acc)
     try:
-        m.account_update_credentials(avatar=message.filename)
+        _call(acc, 'account_update_credentials', avatar=message.filename)
         replies.add(text='Avatar updated')
     except mastodon.MastodonAPIError:
         replies.add(text='Failed to update avatar')
@@ -243,7 +297,7 @@ def m_dm(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> Non
         replies.add(text='Wrong Syntax')
         return
 
-    user = _get_user(_get_session(acc), payload)
+    user = _get_user(acc, payload)
     if not user:
         replies.add(text='Account not found: ' + payload)
         return
@@ -259,21 +313,14 @@ def m_dm(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> Non
         g = bot.create_group(title, [acc['addr']])
         db.add_pchat(g.id, payload, acc['id'])
 
-        r = requests.get(user.avatar_static)
-        with NamedTemporaryFile(dir=bot.account.get_blobdir(), suffix='.jpg', delete=False) as file:
-            path = file.name
-        with open(path, "wb") as file:
-            file.write(r.content)
-        try:
-            g.set_profile_image(path)
-        except ValueError as err:
-            bot.logger.exception(err)
+        _set_avatar(bot, g, user.avatar_static)
         replies.add(
             text='Private chat with: ' + user.acct, chat=g)
 
 
 @simplebot.command
-def m_reply(payload: str, message: Message, replies: Replies) -> None:
+def m_reply(bot: DeltaBot, payload: str, message: Message,
+            replies: Replies) -> None:
     """Reply to a toot with the given id.
     """
     acc_id, toot_id, text = payload.split(maxsplit=2)
@@ -288,8 +335,8 @@ def m_reply(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Invalid toot or account id')
         return
 
-    _toot(_get_session(acc), text=text, filename=message.filename,
-          in_reply_to=toot_id)
+    _send_toot(bot, message, replies, acc, text,
+               in_reply_to=toot_id)
 
 
 @simplebot.command
@@ -304,8 +351,7 @@ def m_star(args: list, message: Message, replies: Replies) -> None:
         replies.add(text='Invalid toot or account id')
         return
 
-    m = _get_session(acc)
-    m.status_favourite(toot_id)
+    _call(acc, 'status_favourite', toot_id)
 
 
 @simplebot.command
@@ -320,8 +366,7 @@ def m_boost(args: list, message: Message, replies: Replies) -> None:
         replies.add(text='Invalid toot or account id')
         return
 
-    m = _get_session(acc)
-    m.status_reblog(toot_id)
+    _call(acc, 'status_reblog', toot_id)
 
 
 @simplebot.command
@@ -336,8 +381,7 @@ def m_cntx(args: list, message: Message, replies: Replies) -> None:
         replies.add(text='Invalid toot or account id')
         return
 
-    m = _get_session(acc)
-    toots = m.status_context(toot_id)['ancestors']
+    toots = _call(acc, 'status_context', toot_id)['ancestors']
     if toots:
         replies.add(text=TOOT_SEP.join(_toots2text(toots[-3:], acc['id'])))
     else:
@@ -369,15 +413,14 @@ def m_follow(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Wrong Syntax')
         return
 
-    m = _get_session(acc)
     if payload.isdigit():
         user_id = payload
     else:
-        user_id = _get_user(m, payload)
+        user_id = _get_user(acc, payload)
         if user_id is None:
             replies.add(text='Invalid user')
             return
-    m.account_follow(user_id)
+    _call(acc, 'account_follow', user_id)
     replies.add(text='User followed')
 
 
@@ -406,15 +449,14 @@ def m_unfollow(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Wrong Syntax')
         return
 
-    m = _get_session(acc)
     if payload.isdigit():
         user_id = payload
     else:
-        user_id = _get_user(m, payload)
+        user_id = _get_user(acc, payload)
         if user_id is None:
             replies.add(text='Invalid user')
             return
-    m.account_unfollow(user_id)
+    _call(acc, 'account_unfollow', user_id)
     replies.add(text='User unfollowed')
 
 
@@ -444,15 +486,14 @@ def m_mute(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Wrong Syntax')
         return
 
-    m = _get_session(acc)
     if payload.isdigit():
         user_id = payload
     else:
-        user_id = _get_user(m, payload)
+        user_id = _get_user(acc, payload)
         if user_id is None:
             replies.add(text='Invalid user')
             return
-    m.account_mute(user_id)
+    _call(acc, 'account_mute', user_id)
     replies.add(text='User muted')
 
 
@@ -481,15 +522,14 @@ def m_unmute(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Wrong Syntax')
         return
 
-    m = _get_session(acc)
     if payload.isdigit():
         user_id = payload
     else:
-        user_id = _get_user(m, payload)
+        user_id = _get_user(acc, payload)
         if user_id is None:
             replies.add(text='Invalid user')
             return
-    m.account_unmute(user_id)
+    _call(acc, 'account_unmute', user_id)
     replies.add(text='User unmuted')
 
 
@@ -519,15 +559,14 @@ def m_block(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Wrong Syntax')
         return
 
-    m = _get_session(acc)
     if payload.isdigit():
         user_id = payload
     else:
-        user_id = _get_user(m, payload)
+        user_id = _get_user(acc, payload)
         if user_id is None:
             replies.add(text='Invalid user')
             return
-    m.account_block(user_id)
+    _call(acc, 'account_block', user_id)
     replies.add(text='User blocked')
 
 
@@ -556,15 +595,14 @@ def m_unblock(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Wrong Syntax')
         return
 
-    m = _get_session(acc)
     if payload.isdigit():
         user_id = payload
     else:
-        user_id = _get_user(m, payload)
+        user_id = _get_user(acc, payload)
         if user_id is None:
             replies.add(text='Invalid user')
             return
-    m.account_unblock(user_id)
+    _call(acc, 'account_unblock', user_id)
     replies.add(text='User unblocked')
 
 
@@ -590,17 +628,17 @@ def m_profile(payload: str, message: Message, replies: Replies) -> None:
             text='You must send that command in you Mastodon chats')
         return
 
-    m = _get_session(acc)
-    me = m.me()
+    me_id = _get_me_id(acc)
     if not payload:
-        user = me
+        user = _call(acc, 'me')
     else:
-        user = _get_user(m, payload)
+        user = _get_user(acc, payload)
         if user is None:
             replies.add(text='Invalid user')
             return
 
-    rel = m.account_relationships(user)[0] if user.id != me.id else None
+    rel = _call(acc, 'account_relationships', user)[0] if (
+        user.id != me_id) else None
     text = '{}:\n\n'.format(_get_name(user))
     fields = ''
     for f in user.fields:
@@ -611,7 +649,7 @@ def m_profile(payload: str, message: Message, replies: Replies) -> None:
     text += html2text(user.note).strip()
     text += '\n\nToots: {}\nFollowing: {}\nFollowers: {}'.format(
         user.statuses_count, user.following_count, user.followers_count)
-    if user.id != me.id:
+    if user.id != me_id:
         if rel['followed_by']:
             text += '\n[follows you]'
         elif rel['blocked_by']:
@@ -628,7 +666,7 @@ def m_profile(payload: str, message: Message, replies: Replies) -> None:
         text += '\n/m_{}_{}_{}'.format(action, acc['id'], user.id)
         text += '\n/m_dm_{}_{}'.format(acc['id'], user.id)
     text += TOOT_SEP
-    toots = m.account_statuses(user, limit=10)
+    toots = _call(acc, 'account_statuses', user, limit=10)
     text += TOOT_SEP.join(_toots2text(toots, acc['id']))
     replies.add(text=text)
 
@@ -653,8 +691,7 @@ def m_local(payload: str, message: Message, replies: Replies) -> None:
             text='You must send that command in you Mastodon chats')
         return
 
-    m = _get_session(acc)
-    toots = m.timeline_local()
+    toots = _call(acc, 'timeline_local')
     if toots:
         replies.add(text=TOOT_SEP.join(_toots2text(toots, acc['id'])))
     else:
@@ -681,8 +718,7 @@ def m_public(payload: str, message: Message, replies: Replies) -> None:
             text='You must send that command in you Mastodon chats')
         return
 
-    m = _get_session(acc)
-    toots = m.timeline_public()
+    toots = _call(acc, 'timeline_public')
     if toots:
         replies.add(text=TOOT_SEP.join(_toots2text(toots, acc['id'])))
     else:
@@ -715,8 +751,7 @@ def m_tag(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Wrong Syntax')
         return
 
-    m = _get_session(acc)
-    toots = m.timeline_hashtag(payload)
+    toots = _call(acc, 'timeline_hashtag', payload)
     if toots:
         replies.add(text=TOOT_SEP.join(_toots2text(toots, acc['id'])))
     else:
@@ -748,8 +783,7 @@ def m_search(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Wrong Syntax')
         return
 
-    m = _get_session(acc)
-    res = m.search(payload)
+    res = _call(acc, 'search', payload)
     text = ''
     if res['accounts']:
         text += '👤 Accounts:'
@@ -767,36 +801,90 @@ def m_search(payload: str, message: Message, replies: Replies) -> None:
         replies.add(text='Nothing found')
 
 
-def _get_session(acc) -> mastodon.Mastodon:
-    client = db.get_client(acc['api_url'])
+def _get_session(acc: sqlite3.Row,
+                 renew: bool = False) -> mastodon.Mastodon:
+    """Get a client for the given account, logging in again if `renew`.
+    """
+    m = None if renew else sessions.get(acc['id'])
+    if m is None:
+        token = None if renew else acc['token']
+        if not token:
+            token = _log_in(acc['api_url'], acc['email'], acc['password'])
+            db.set_token(acc['id'], token)
+        m = _new_client(acc['api_url'], token)
+        sessions.put(acc['id'], m)
+    return m
+
+
+def _call(acc: sqlite3.Row, method: str, *args, **kwargs) -> Any:
+    """Call the given method of the account's client.
+    """
+    try:
+        return getattr(_get_session(acc), method)(*args, **kwargs)
+    except mastodon.MastodonUnauthorizedError:
+        m = _get_session(acc, renew=True)
+        return getattr(m, method)(*args, **kwargs)
+
+
+def _new_client(api_url: str, token: str) -> mastodon.Mastodon:
+    return mastodon.Mastodon(access_token=token, api_base_url=api_url,
+                             ratelimit_method='throw', session=http)
+
+
+def _log_in(api_url: str, email: str, password: str) -> str:
+    """Get a new access token for the given account."""
+    client = db.get_client(api_url)
     if client:
         client_id, client_secret = client['id'], client['secret']
     else:
         client_id, client_secret = mastodon.Mastodon.create_app(
-            'DeltaChat Bridge', api_base_url=acc['api_url'])
-        db.add_client(acc['api_url'], client_id, client_secret)
+            'DeltaChat Bridge', api_base_url=api_url, session=http)
+        db.add_client(api_url, client_id, client_secret)
     m = mastodon.Mastodon(client_id=client_id,
                           client_secret=client_secret,
-                          api_base_url=acc['api_url'],
-                          ratelimit_method='throw')
-    m.log_in(acc['email'], acc['password'])
-    return m
+                          api_base_url=api_url,
+                          ratelimit_method='throw', session=http)
+    return m.log_in(email, password)
 
 
-def _get_user(m, user_id) -> Any:
+def _get_user(acc: sqlite3.Row, user_id) -> Any:
+    if not user_id.isdigit():
+        user_id = user_id.lstrip('@').lower()
+    key = (acc['api_url'], user_id)
+    user = users.get(key, users)
+    if user is not users:
+        return user
+
     user = None
     if user_id.isdigit():
-        user = m.account(user_id)
+        try:
+            user = _call(acc, 'account', user_id)
+        except mastodon.MastodonNotFoundError:
+            pass
     else:
-        user_id = user_id.lstrip('@').lower()
         ids = (user_id, user_id.split('@')[0])
-        for a in m.account_search(user_id):
+        for a in _call(acc, 'account_search', user_id):
             if a.acct.lower() in ids:
                 user = a
                 break
+    if user is None:
+        users.put(key, None, USER_NOT_FOUND_TTL)
+    else:
+        users.put(key, user)
     return user
 
 
+def _get_me_id(acc: sqlite3.Row) -> Any:
+    """Get the id of the account's Mastodon user, cached for me_ttl
+    seconds.
+    """
+    me_id = me_ids.get(acc['id'])
+    if me_id is None:
+        me_id = _call(acc, 'me').id
+        me_ids.put(acc['id'], me_id)
+    return me_id
+
+
 def _get_name(macc) -> str:
     isbot = '[BOT] ' if macc.bot else ''
     if macc.display_name:
@@ -833,25 +921,7 @@ def _toots2text(toots: list, acc_id: int,
         else:
             text = '{}:\n\n'.format(_get_name(t.account))
 
-        media_urls = '\n'.join(
-            media.url for media in t.media_attachments)
-        if media_urls:
-            text += media_urls + '\n\n'
-
-        soup = BeautifulSoup(
-            t.content, 'html.parser')
-        if t.mentions:
-            accts = {e.url: '@' + e.acct
-                     for e in t.mentions}
-            for a in soup('a', class_='u-url'):
-                name = accts.get(a['href'])
-                if name:
-                    a.string = name
-        for br in soup('br'):
-            br.replace_with('\n')
-        for p in soup('p'):
-            p.replace_with(p.get_text()+'\n\n')
-        text += soup.get_text()
+        text += _toot_body(t)
 
         text += '\n\n[{} {}]\n'.format(
             v2emoji[t.visibility], t.created_at.strftime(STRFORMAT))
@@ -865,26 +935,60 @@ def _toots2text(toots: list, acc_id: int,
         yield text
 
 
-def _toot(masto: mastodon.Mastodon, text: str = None, filename: str = None,
+def _toot_body(t) -> str:
+    """Get the media URLs and the text of the given toot."""
+    text = ''
+    media_urls = '\n'.join(
+        media.url for media in t.media_attachments)
+    if media_urls:
+        text += media_urls + '\n\n'
+    accts = {e.url: '@' + e.acct for e in t.mentions}
+    return text + toot2text(t.content, accts)
+
+
+def _send_toot(bot: DeltaBot, message: Message, replies: Replies,
+               acc: sqlite3.Row, text: str, **kwargs) -> None:
+    """Toot the given message, voice messages are converted to MP3 and
+    tooted in the background.
+    """
+    if not message.filename or not message.filename.endswith('.aac'):
+        _toot(acc, text, message.filename, **kwargs)
+        return
+
+    chat = message.chat
+
+    def _post(future: Future) -> None:
+        try:
+            _toot(acc, text, future.result(), **kwargs)
+        except Exception as ex:
+            bot.logger.exception(ex)
+            chat.send_text('❌ Failed to send voice message: {}'.format(ex))
+        finally:
+            if not future.exception():
+                transcoder.release(future.result())
+
+    transcoder.to_mp3(message.filename).add_done_callback(
+        lambda future: uploads.submit(_post, future))
+    replies.add(text='⏳ Voice message will be sent after conversion',
+                quote=message)
+
+
+def _toot(acc: sqlite3.Row, text: str = None, filename: str = None,
           visibility: str = None, in_reply_to: str = None) -> None:
     if filename:
-        if filename.endswith('.aac'):
-            aac_file = AudioSegment.from_file(filename, 'aac')
-            filename = filename[:-4] + '.mp3'
-            aac_file.export(filename, format='mp3')
-        media = [masto.media_post(filename).id]
+        media = [_call(acc, 'media_post', filename).id]
         if in_reply_to:
-            masto.status_reply(masto.status(in_reply_to), text,
-                               media_ids=media, visibility=visibility)
+            _call(acc, 'status_reply', _call(acc, 'status', in_reply_to),
+                  text, media_ids=media, visibility=visibility)
         else:
-            masto.status_post(
-                text, media_ids=media, visibility=visibility)
+            _call(acc, 'status_post',
+                  text, media_ids=media, visibility=visibility)
     elif text:
         if in_reply_to:
-            masto.status_reply(
-                masto.status(in_reply_to), text, visibility=visibility)
+            _call(acc, 'status_reply', _call(acc, 'status', in_reply_to),
+                  text, visibility=visibility)
         else:
-            masto.status_post(text, visibility=visibility)
+            _call(acc, 'status_post', text, visibility=visibility)
 
 
 def _normalize_url(url: str) -> str:
@@ -910,6 +1014,13 @@ def _get_db(bot: DeltaBot) -> DBManager:
     return DBManager(os.path.join(path, 'sqlite.db'))
 
 
+def _set_avatar(bot: DeltaBot, chat: Chat, url: str) -> None:
+    try:
+        chat.set_profile_image(avatars.get(url))
+    except (requests.RequestException, OSError, ValueError) as err:
+        bot.logger.exception(err)
+
+
 def _rmprefix(text, prefix) -> str:
     return text[text.startswith(prefix) and len(prefix):]
 
@@ -931,129 +1042,332 @@ def _logout(bot: DeltaBot, acc, replies: Replies) -> None:
     except ValueError:
         pass
     db.remove_account(acc['id'])
+    sessions.pop(acc['id'])
+    me_ids.pop(acc['id'])
+    cursor_locks.pop(acc['id'], None)
+    _stop_stream(acc['id'])
     replies.add(text='You have logged out from: ' + acc['api_url'],
                 chat=bot.get_chat(acc['addr']))
 
 
-def _check_notifications(bot: DeltaBot, acc: sqlite3.Row, m: mastodon.Mastodon) -> None:
-    max_id = None
+def _check_notifications(bot: DeltaBot,
+                         acc: sqlite3.Row) -> Tuple[int, bool]:
+    """Send the new notifications, see _CatchUp."""
+    new = 0
+    chat = bot.get_chat(acc['notif'])
+    pages = _CatchUp(bot, partial(_call, acc, 'notifications'),
+                     acc['last_notif'])
+    for ns in pages:
+        new += len(_deliver(acc['id'], 'last_notif', ns, partial(
+            _send_notifications, bot, acc, chat)))
+    bot.logger.debug('Notifications: %s new entries (last id: %s)',
+                      new, acc['last_notif'])
+    return new, pages.behind
+
+
+def _send_notifications(bot: DeltaBot, acc: sqlite3.Row, chat: Chat,
+                        ns: list) -> None:
     dmsgs = []
     notifications = []
-    while True:
-        ns = m.notifications(
-            max_id=max_id, since_id=acc['last_notif'])
-        if not ns:
-            break
-        if max_id is None:
-            db.set_last_notif(acc['id'], ns[0].id)
-        max_id = ns[-1]
-        for n in ns:
-            if n.type == 'mention' and n.status.visibility == Visibility.DIRECT and len(n.status.mentions) == 1:
-                dmsgs.append(n.status)
-            else:
-                notifications.append(n)
-    for dm in reversed(dmsgs):
-        text = '{}:\n\n'.format(_get_name(dm.account))
-
-        media_urls = '\n'.join(
-            media.url for media in dm.media_attachments)
-        if media_urls:
-            text += media_urls + '\n\n'
-
-        soup = BeautifulSoup(dm.content, 'html.parser')
-        accts = {e.url: '@'+e.acct
-                 for e in dm.mentions}
-        for a in soup('a', class_='u-url'):
-            name = accts.get(a['href'])
-            if name:
-                a.string = name
-        for br in soup('br'):
-            br.replace_with('\n')
-        for p in soup('p'):
-            p.replace_with(p.get_text()+'\n\n')
-        text += soup.get_text()
-        text += '\n\n[{} {}]\n'.format(
-            v2emoji[dm.visibility], dm.created_at.strftime(STRFORMAT))
-        text += '⭐ /m_star_{}_{}\n'.format(
-            acc['id'], dm.id)
-
-        pv = db.get_pchat_by_contact(acc['id'], dm.account.acct)
-        if pv:
-            g = bot.get_chat(pv['id'])
-            if g is None:
-                db.remove_pchat(pv['id'])
-            else:
-                g.send_text(text)
+    for n in ns:
+        if n.type == 'mention' and n.status.visibility == Visibility.DIRECT and len(n.status.mentions) == 1:
+            dmsgs.append(n.status)
         else:
-            url = _rmprefix(acc['api_url'], 'https://')
-            g = bot.create_group(
-                '🇲 {} ({})'.format(dm.account.acct, url), [acc['addr']])
-            db.add_pchat(g.id, dm.account.acct, acc['id'])
-
-            r = requests.get(dm.account.avatar_static)
-            with NamedTemporaryFile(dir=bot.account.get_blobdir(), suffix='.jpg', delete=False) as file:
-                path = file.name
-            with open(path, "wb") as file:
-                file.write(r.content)
-            try:
-                g.set_profile_image(path)
-            except ValueError as err:
-                bot.logger.exception(err)
+            notifications.append(n)
+    for dm in reversed(dmsgs):
+        _send_dm(bot, acc, dm)
+    _send_toots(bot, chat, _toots2text(notifications, acc['id'], True))
+
 
+def _send_dm(bot: DeltaBot, acc: sqlite3.Row, dm) -> None:
+    """Send a direct message to its private chat, creating the chat if
+    needed.
+    """
+    text = '{}:\n\n'.format(_get_name(dm.account))
+    text += _toot_body(dm)
+    text += '\n\n[{} {}]\n'.format(
+        v2emoji[dm.visibility], dm.created_at.strftime(STRFORMAT))
+    text += '⭐ /m_star_{}_{}\n'.format(
+        acc['id'], dm.id)
+
+    pv = db.get_pchat_by_contact(acc['id'], dm.account.acct)
+    if pv:
+        g = bot.get_chat(pv['id'])
+        if g is None:
+            db.remove_pchat(pv['id'])
+        else:
             g.send_text(text)
+    else:
+        url = _rmprefix(acc['api_url'], 'https://')
+        g = bot.create_group(
+            '🇲 {} ({})'.format(dm.account.acct, url), [acc['addr']])
+        db.add_pchat(g.id, dm.account.acct, acc['id'])
 
-    bot.logger.debug('Notifications: %s new entries (last id: %s)',
-                      len(notifications), acc['last_notif'])
-    if notifications:
-        bot.get_chat(acc['notif']).send_text(TOOT_SEP.join(
-            _toots2text(notifications, acc['id'], True)))
+        _set_avatar(bot, g, dm.account.avatar_static)
+
+        g.send_text(text)
 
 
-def _check_home(bot: DeltaBot, acc: sqlite3.Row, m: mastodon.Mastodon) -> None:
-    me = m.me()
-    max_id = None
-    toots: list = []
+def _check_home(bot: DeltaBot, acc: sqlite3.Row) -> Tuple[int, bool]:
+    """Send the new toots of the home timeline, see _CatchUp."""
+    me_id = _get_me_id(acc)
+    new = 0
+    chat = bot.get_chat(acc['home'])
+    pages = _CatchUp(bot, partial(_call, acc, 'timeline_home'),
+                     acc['last_home'])
+    for ts in pages:
+        new += len(_deliver(acc['id'], 'last_home', ts, partial(
+            _send_home_toots, bot, chat, acc['id'], me_id)))
+    bot.logger.debug('Home: %s new entries (last id: %s)',
+                      new, acc['last_home'])
+    return new, pages.behind
+
+
+def _send_home_toots(bot: DeltaBot, chat: Chat, acc_id: int, me_id: Any,
+                     toots: list) -> None:
+    """Send the given toots, except those mentioning the user, which
+    arrive as notifications.
+    """
+    toots = [t for t in toots if all(a.id != me_id for a in t.mentions)]
+    _send_toots(bot, chat, _toots2text(toots, acc_id))
+
+
+def _deliver(acc_id: int, cursor: str, items: list,
+             send: Callable[[list], None]) -> list:
+    """Send the items newer than the account's `cursor` and move it.
+    """
+    with cursor_locks.setdefault(acc_id, Lock()):
+        acc = db.get_account_by_id(acc_id)
+        if not acc:
+            return []
+        items = [i for i in items if _is_newer(i.id, acc[cursor])]
+        if items:
+            send(items)
+            if cursor == 'last_home':
+                db.set_last_home(acc_id, items[0].id)
+            else:
+                db.set_last_notif(acc_id, items[0].id)
+    return items
+
+
+class _CatchUp:
+    """Iterate over the pages of items newer than `last_id`, oldest first.
+    """
+
+    def __init__(self, bot: DeltaBot, fetch, last_id: Any) -> None:
+        self.fetch = fetch
+        self.last_id = last_id
+        self.pages = int(_getdefault(bot, 'catchup_pages'))
+        self.limit = int(_getdefault(bot, 'page_size'))
+        self.behind = False
+
+    def __iter__(self) -> Generator:
+        for _ in range(self.pages):
+            page = self.fetch(min_id=self.last_id, limit=self.limit)
+            if not page:
+                return
+            yield page
+            self.last_id = page[0].id
+            if len(page) < self.limit:
+                return
+        self.behind = True
+
+
+def _send_toots(bot: DeltaBot, chat: Chat, texts: Generator) -> None:
+    """Send the given toots to the chat.
+    """
+    if not int(_getdefault(bot, 'digest')):
+        for text in texts:
+            chat.send_text(text)
+        return
+
+    max_size = int(_getdefault(bot, 'digest_size'))
+    batch: List[str] = []
+    size = 0
+    for text in texts:
+        if batch and size + len(TOOT_SEP) + len(text) > max_size:
+            chat.send_text(TOOT_SEP.join(batch))
+            batch, size = [], 0
+        size += len(text) + (len(TOOT_SEP) if batch else 0)
+        batch.append(text)
+    if batch:
+        chat.send_text(TOOT_SEP.join(batch))
+
+
+def _check_account(bot: DeltaBot, acc: sqlite3.Row) -> int:
+    """Poll the account, returning the number of new toots and
+    notifications.
+    """
+    new, behind = _check_notifications(bot, acc)
+    new_home, behind_home = _check_home(bot, acc)
+    new += new_home
+    # the stream would move the cursors past the pending items
+    if stream_queues and acc['id'] not in streams and not (
+            behind or behind_home):
+        _start_stream(bot, acc)
+    return new
+
+
+class AccountListener(mastodon.StreamListener):
+    """Queue the events of an account's user stream, events of the same
+    account always go to the same queue so they are processed in order.
+    """
+
+    def __init__(self, acc_id: int, me_id: Any) -> None:
+        self.acc_id = acc_id
+        self.me_id = me_id
+        self.queue = stream_queues[acc_id % len(stream_queues)]
+
+    def on_update(self, status) -> None:
+        self.queue.put((self, 'update', status))
+
+    def on_notification(self, notification) -> None:
+        self.queue.put((self, 'notification', notification))
+
+
+def _start_stream(bot: DeltaBot, acc: sqlite3.Row) -> None:
+    """Subscribe to the account's user stream.
+    """
+    try:
+        sm = mastodon.Mastodon(access_token=_get_session(acc).access_token,
+                               api_base_url=acc['api_url'],
+                               session=requests.Session())
+        streams[acc['id']] = sm.stream_user(
+            AccountListener(acc['id'], _get_me_id(acc)), run_async=True,
+            reconnect_async=True, reconnect_async_wait_sec=30)
+    except Exception as ex:
+        bot.logger.warning('Streaming not available for %s: %s',
+                           acc['api_url'], ex)
+
+
+def _stop_stream(acc_id: int) -> None:
+    handle = streams.pop(acc_id, None)
+    if handle:
+        try:
+            handle.close()
+        except Exception:
+            pass
+
+
+def _is_streaming(acc_id: int) -> bool:
+    handle = streams.get(acc_id)
+    if handle is not None and not handle.is_alive():
+        streams.pop(acc_id, None)
+        return False
+    return handle is not None and handle.is_receiving()
+
+
+def _process_stream_events(bot: DeltaBot, queue: Queue) -> None:
     while True:
-        ts = m.timeline_home(max_id=max_id, since_id=acc['last_home'])
-        if not ts:
-            break
-        if max_id is None:
-            db.set_last_home(acc['id'], ts[0].id)
-        max_id = ts[-1]
-        for t in ts:
-            for a in t.mentions:
-                if a.id == me.id:
-                    break
+        listener, event, data = queue.get()
+        acc = db.get_account_by_id(listener.acc_id)
+        if not acc:
+            _stop_stream(listener.acc_id)
+            continue
+        try:
+            if event == 'update':
+                _on_home_toot(bot, acc, listener.me_id, data)
             else:
-                toots.append(t)
-    bot.logger.debug('Home: %s new entries (last id: %s)',
-                      len(toots), acc['last_home'])
-    if toots:
-        bot.get_chat(acc['home']).send_text(TOOT_SEP.join(
-            _toots2text(toots, acc['id'])))
+                _on_notification(bot, acc, data)
+        except Exception as ex:
+            bot.logger.exception(ex)
+
+
+def _on_home_toot(bot: DeltaBot, acc: sqlite3.Row, me_id: Any,
+                  toot) -> None:
+    _deliver(acc['id'], 'last_home', [toot], partial(
+        _send_home_toots, bot, bot.get_chat(acc['home']), acc['id'], me_id))
+
+
+def _on_notification(bot: DeltaBot, acc: sqlite3.Row, n) -> None:
+    _deliver(acc['id'], 'last_notif', [n], partial(
+        _send_notifications, bot, acc, bot.get_chat(acc['notif'])))
+
+
+def _is_newer(toot_id, last_id) -> bool:
+    """Compare Mastodon ids, numeric strings of arbitrary length."""
+    if last_id is None:
+        return True
+    toot_id, last_id = str(toot_id), str(last_id)
+    return (len(toot_id), toot_id) > (len(last_id), last_id)
 
 
 def _listen_to_mastodon(bot: DeltaBot) -> None:
+    """Poll the accounts as they become due.
+    """
+    pool = ThreadPoolExecutor(
+        max_workers=int(_getdefault(bot, 'instance_workers')),
+        thread_name_prefix='mastodon')
+    lanes: Dict[str, Future] = {}
     while True:
-        bot.logger.info('Checking Mastodon')
-        instances: dict = {}
-        for acc in db.get_accounts():
-            instances.setdefault(acc['api_url'], []).append(acc)
-        while instances:
-            for key in list(instances.keys()):
-                if not instances[key]:
-                    instances.pop(key)
+        bot.logger.debug('Checking Mastodon')
+        for url in [url for url, lane in lanes.items() if lane.done()]:
+            lanes.pop(url)
+        try:
+            instances: dict = {}
+            for acc in db.get_due_accounts(time.time()):
+                if acc['api_url'] in lanes:
+                    continue
+                if _is_streaming(acc['id']):
+                    _reschedule(bot, acc, 0)
                     continue
-                acc = instances[key].pop()
-                try:
-                    m = _get_session(acc)
-                    _check_notifications(bot, acc, m)
-                    _check_home(bot, acc, m)
-                except (mastodon.MastodonUnauthorizedError, mastodon.MastodonAPIError):
-                    db.remove_account(acc['id'])
-                    bot.get_chat(acc['addr']).send_text(
-                        'ERROR! You have been logged out from: ' + acc['api_url'])
-                except Exception as ex:
-                    bot.logger.exception(ex)
-            time.sleep(2)
-        time.sleep(int(_getdefault(bot, 'delay')))
+                instances.setdefault(acc['api_url'], []).append(acc)
+            for url, accs in instances.items():
+                lanes[url] = pool.submit(_check_instance, bot, accs)
+            next_poll = db.get_next_poll()
+        except Exception as ex:
+            bot.logger.exception(ex)
+            next_poll = None
+
+        min_delay = float(_getdefault(bot, 'min_delay'))
+        if next_poll is None:
+            time.sleep(min_delay)
+        else:
+            time.sleep(min(max(next_poll - time.time(), 1), min_delay))
+
+
+def _check_instance(bot: DeltaBot, accs: List[sqlite3.Row]) -> None:
+    for acc in accs:
+        try:
+            new = _check_account(bot, acc)
+        except mastodon.MastodonRatelimitError:
+            m = sessions.get(acc['id'])
+            _reschedule(bot, acc, 0, m.ratelimit_reset if m else None)
+        except (mastodon.MastodonServerError, mastodon.MastodonNetworkError) as ex:
+            bot.logger.warning('Failed to check %s: %s', acc['api_url'], ex)
+            _reschedule(bot, acc, 0)
+        except (mastodon.MastodonUnauthorizedError, mastodon.MastodonAPIError):
+            db.remove_account(acc['id'])
+            sessions.pop(acc['id'])
+            me_ids.pop(acc['id'])
+            cursor_locks.pop(acc['id'], None)
+            _stop_stream(acc['id'])
+            bot.get_chat(acc['addr']).send_text(
+                'ERROR! You have been logged out from: ' + acc['api_url'])
+        except Exception as ex:
+            bot.logger.exception(ex)
+            _reschedule(bot, acc, 0)
+        else:
+            m = sessions.get(acc['id'])
+            _reschedule(bot, acc, new, time.time() + _pace(m) if m else None)
+
+
+def _reschedule(bot: DeltaBot, acc: sqlite3.Row, new: int,
+                not_before: float = None) -> None:
+    """Set the next time the account should be polled.
+    """
+    interval = acc['poll_interval'] or float(_getdefault(bot, 'delay'))
+    interval = interval / 2 if new else interval * 1.5
+    interval = min(max(interval, float(_getdefault(bot, 'min_delay'))),
+                   float(_getdefault(bot, 'max_delay')))
+    next_poll = max(time.time() + interval, not_before or 0)
+    db.schedule_account(acc['id'], next_poll, interval)
+
+
+def _pace(m: mastodon.Mastodon) -> float:
+    """Get the seconds to wait before polling again with the given client.
+    """
+    window = m.ratelimit_reset - time.time()
+    if window <= 0:
+        return 0
+    return window / max(m.ratelimit_remaining, 1) * POLL_CALLS
@@ -0,0 +1,94 @@
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+from .db import DBManager
+
+
+class AvatarCache:
+    """On-disk cache of avatar images.
+
+    Images are stored under their content hash, so the same image is kept
+    only once even if it is served from several URLs, and indexed by URL in
+    the database. Cached images are revalidated with the server, using
+    ETag/Last-Modified, once they are older than `ttl` seconds, and the
+    least recently used ones are deleted when the cache grows over
+    `max_size` bytes.
+    """
+
+    def __init__(self, db: DBManager, path: str, session: requests.Session,
+                 max_size: int, ttl: float, timeout: float = 30) -> None:
+        self.db = db
+        self.path = path
+        self.session = session
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def get(self, url: str) -> str:
+        """Get the path of the image at the given URL, downloading it only
+        if it is not cached or it changed.
+        """
+        now = time.time()
+        row = self.db.get_avatar(url)
+        if row and not os.path.exists(os.path.join(self.path, row['file'])):
+            row = None
+        if row and now - row['checked'] < self.ttl:
+            self.db.touch_avatar(url, now)
+            return os.path.join(self.path, row['file'])
+
+        headers = {}
+        if row and row['etag']:
+            headers['If-None-Match'] = row['etag']
+        if row and row['modified']:
+            headers['If-Modified-Since'] = row['modified']
+        with self.session.get(url, headers=headers,
+                              timeout=self.timeout) as resp:
+            if row and resp.status_code == 304:
+                self.db.set_avatar(url, row['file'], row['etag'],
+                                   row['modified'], row['size'], now)
+                return os.path.join(self.path, row['file'])
+            resp.raise_for_status()
+            content = resp.content
+            ext = os.path.splitext(urlparse(url).path)[1] or \
+                mimetypes.guess_extension(
+                    resp.headers.get('content-type', '').split(';')[0]) or ''
+            name = hashlib.sha1(content).hexdigest() + ext.lower()
+            path = os.path.join(self.path, name)
+            if not os.path.exists(path):
+                tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+                with open(tmp, 'wb') as fh:
+                    fh.write(content)
+                os.replace(tmp, path)
+            self.db.set_avatar(url, name, resp.headers.get('etag'),
+                               resp.headers.get('last-modified'),
+                               len(content), now)
+        self.evict()
+        return path
+
+    def evict(self) -> None:
+        """Delete the least recently used images over the size limit."""
+        with self.lock:
+            size, kept = 0, set()
+            for row in self.db.get_avatars():
+                if row['file'] in kept:
+                    continue
+                if size + row['size'] <= self.max_size:
+                    size += row['size']
+                    kept.add(row['file'])
+                    continue
+                self.db.remove_avatar(row['url'])
+            for name in os.listdir(self.path):
+                if name not in kept and not name.endswith('.tmp'):
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except OSError:
+                        pass
@@ -0,0 +1,45 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class LRUCache:
+    """Thread-safe mapping keeping only the `maxsize` most recently used
+    items.
+
+    If `ttl` is given, items expire that many seconds after they were put,
+    a different `ttl` can be given for every item.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            expires, value = self.items[key]
+            if expires is not None and expires <= time.monotonic():
+                del self.items[key]
+                return default
+            return value
+
+    def put(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.items[key] = (expires, value)
+            self.items.move_to_end(key)
+            while len(self.items) > max(self.maxsize, 0):
+                self.items.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            item = self.items.pop(key, None)
+        return default if item is None else item[1]
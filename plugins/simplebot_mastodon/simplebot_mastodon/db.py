@@ -1,12 +1,19 @@
 import sqlite3
-from typing import List, Optional
+import threading
+from typing import List, Optional, Set
 
 
 class DBManager:
     def __init__(self, db_path: str) -> None:
+        # the connection is shared by the bot, polling, stream and upload
+        # threads, every statement and transaction holds this lock
+        self.lock = threading.RLock()
         self.db = sqlite3.connect(db_path, check_same_thread=False)
         self.db.row_factory = sqlite3.Row
-        with self.db:
+        # ids of the home, notifications and private chats, loaded lazily
+        self._chats: Optional[Set[int]] = None
+        self._chats_lock = threading.Lock()
+        with self.lock, self.db:
             self.db.execute(
                 '''CREATE TABLE IF NOT EXISTS accounts
                 (id INTEGER PRIMARY KEY,
@@ -29,100 +36,224 @@ class DBManager:
                 (api_url TEXT PRIMARY KEY,
                 id TEXT NOT NULL,
                 secret TEXT NOT NULL)''')
+            self._add_columns('accounts', (
+                ('token', 'TEXT'),
+                ('next_poll', 'REAL NOT NULL DEFAULT 0'),
+                ('poll_interval', 'REAL'),
+            ))
+            for column in ('next_poll', 'home', 'notif', 'addr', 'api_url'):
+                self.db.execute(
+                    'CREATE INDEX IF NOT EXISTS accounts_{0} ON accounts ({0})'
+                    .format(column))
+            self.db.execute(
+                '''CREATE INDEX IF NOT EXISTS pchats_account_contact
+                ON pchats (account, contact)''')
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS avatars
+                (url TEXT PRIMARY KEY,
+                file TEXT NOT NULL,
+                etag TEXT,
+                modified TEXT,
+                size INTEGER NOT NULL,
+                checked REAL NOT NULL,
+                used REAL NOT NULL)''')
+
+    def _add_columns(self, table: str, columns: tuple) -> None:
+        existing = [r['name'] for r in self.db.execute(
+            'PRAGMA table_info({})'.format(table))]
+        for name, definition in columns:
+            if name not in existing:
+                self.db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table, name, definition))
+
+    # ==== chat =====
+
+    def is_mastodon_chat(self, gid: int) -> bool:
+        """Check, without querying the database, whether the given chat is
+        the home, notifications or a private chat of some account.
+        """
+        chats = self._chats
+        if chats is None:
+            with self._chats_lock:
+                if self._chats is None:
+                    with self.lock:
+                        self._chats = {r[0] for r in self.db.execute(
+                            'SELECT home FROM accounts UNION ALL '
+                            'SELECT notif FROM accounts UNION ALL '
+                            'SELECT id FROM pchats')}
+                chats = self._chats
+        return gid in chats
+
+    def _invalidate_chats(self) -> None:
+        with self._chats_lock:
+            self._chats = None
+
+    def resolve_chat(self, gid: int) -> Optional[sqlite3.Row]:
+        """Get the account the given chat belongs to.
+        """
+        q = '''SELECT *, 'home' AS kind, NULL AS contact FROM accounts
+        WHERE home=:gid
+        UNION ALL SELECT *, 'notif', NULL FROM accounts WHERE notif=:gid
+        UNION ALL SELECT accounts.*, 'pchat', pchats.contact FROM pchats
+        JOIN accounts ON accounts.id=pchats.account WHERE pchats.id=:gid
+        LIMIT 1'''
+        with self.lock:
+            return self.db.execute(q, {'gid': gid}).fetchone()
 
     # ==== client =====
 
     def get_client(self, api_url: str) -> Optional[sqlite3.Row]:
-        return self.db.execute(
-            'SELECT * FROM clients WHERE api_url=?', (api_url,)).fetchone()
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM clients WHERE api_url=?', (api_url,)).fetchone()
 
     def add_client(self, api_url: str, client_id: str,
                    client_secret: str) -> None:
         query = 'INSERT INTO clients VALUES (?,?,?)'
-        with self.db:
+        with self.lock, self.db:
             self.db.execute(query, (api_url, client_id, client_secret))
 
     # ==== account =====
 
     def add_account(self, email: str, password: str, api_url: str,
                     accname: str, addr: str, home: int, notif: int,
-                    last_home: str, last_notif: str) -> None:
-        args = (None, email, password, api_url, accname, addr, home,
-                notif, last_home, last_notif)
-        q = 'INSERT INTO accounts VALUES ({})'.format(
+                    last_home: str, last_notif: str,
+                    token: str = None) -> None:
+        args = (email, password, api_url, accname, addr, home,
+                notif, last_home, last_notif, token)
+        q = 'INSERT INTO accounts (email, password, api_url, accname, addr,'
+        q += ' home, notif, last_home, last_notif, token) VALUES ({})'.format(
             ','.join('?' for i in range(len(args))))
-        with self.db:
+        with self.lock, self.db:
             self.db.execute(q, args)
+        self._invalidate_chats()
 
     def remove_account(self, id: int) -> None:
-        with self.db:
+        with self.lock, self.db:
             self.db.execute(
                 'DELETE FROM pchats WHERE account=?', (id,))
             self.db.execute('DELETE FROM accounts WHERE id=?', (id,))
+        self._invalidate_chats()
 
     def set_last_notif(self, id: int, last_notif: str) -> None:
         q = 'UPDATE accounts SET last_notif=? WHERE id=?'
-        with self.db:
+        with self.lock, self.db:
             self.db.execute(q, (last_notif, id))
 
     def set_last_home(self, id: int, last_home: str) -> None:
         q = 'UPDATE accounts SET last_home=? WHERE id=?'
-        with self.db:
+        with self.lock, self.db:
             self.db.execute(q, (last_home, id))
 
+    def set_token(self, id: int, token: str) -> None:
+        q = 'UPDATE accounts SET token=? WHERE id=?'
+        with self.lock, self.db:
+            self.db.execute(q, (token, id))
+
+    def schedule_account(self, id: int, next_poll: float,
+                         interval: float) -> None:
+        q = 'UPDATE accounts SET next_poll=?, poll_interval=? WHERE id=?'
+        with self.lock, self.db:
+            self.db.execute(q, (next_poll, interval, id))
+
+    def get_due_accounts(self, now: float) -> List[sqlite3.Row]:
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM accounts WHERE next_poll<=? ORDER BY next_poll',
+                (now,)).fetchall()
+
+    def get_next_poll(self) -> Optional[float]:
+        with self.lock:
+            return self.db.execute(
+                'SELECT MIN(next_poll) FROM accounts').fetchone()[0]
+
     def get_account(self, gid: int) -> Optional[sqlite3.Row]:
-        q = 'SELECT * FROM accounts WHERE home=? OR notif=?'
-        acc = self.db.execute(q, (gid, gid)).fetchone()
-        if not acc:
-            pchat = self.get_pchat(gid)
-            if pchat:
-                acc = self.get_account_by_id(pchat['account'])
-        return acc
+        if not self.is_mastodon_chat(gid):
+            return None
+        return self.resolve_chat(gid)
 
     def get_account_by_id(self, id: int) -> Optional[sqlite3.Row]:
-        return self.db.execute(
-            'SELECT * FROM accounts WHERE id=?', (id,)).fetchone()
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM accounts WHERE id=?', (id,)).fetchone()
 
     def get_account_by_home(self, gid: int) -> Optional[sqlite3.Row]:
-        return self.db.execute(
-            'SELECT * FROM accounts WHERE home=?', (gid,)).fetchone()
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM accounts WHERE home=?', (gid,)).fetchone()
 
     def get_account_by_user(self, name: str,
                             url: str) -> Optional[sqlite3.Row]:
         q = 'SELECT * FROM accounts WHERE accname=? AND api_url=?'
-        return self.db.execute(q, (name.lower(), url)).fetchone()
+        with self.lock:
+            return self.db.execute(q, (name.lower(), url)).fetchone()
 
     def get_accounts(self, url: str = None,
                      addr: str = None) -> List[sqlite3.Row]:
-        if url:
-            q = 'SELECT * FROM accounts WHERE api_url=?'
-            return self.db.execute(q, (url,)).fetchall()
-        if addr:
-            q = 'SELECT * FROM accounts WHERE addr=?'
-            return self.db.execute(q, (addr,)).fetchall()
-        return self.db.execute('SELECT * FROM accounts').fetchall()
+        with self.lock:
+            if url:
+                q = 'SELECT * FROM accounts WHERE api_url=?'
+                return self.db.execute(q, (url,)).fetchall()
+            if addr:
+                q = 'SELECT * FROM accounts WHERE addr=?'
+                return self.db.execute(q, (addr,)).fetchall()
+            return self.db.execute('SELECT * FROM accounts').fetchall()
 
     # ==== pchat =====
 
     def add_pchat(self, gid: int, contact: str, id: int) -> None:
-        with self.db:
+        with self.lock, self.db:
             self.db.execute(
                 'INSERT INTO pchats VALUES (?,?,?)',
                 (gid, contact.lower(), id))
+        self._invalidate_chats()
 
     def remove_pchat(self, gid: int) -> None:
-        with self.db:
+        with self.lock, self.db:
             self.db.execute('DELETE FROM pchats WHERE id=?', (gid,))
+        self._invalidate_chats()
 
     def get_pchat(self, gid: int) -> Optional[sqlite3.Row]:
-        return self.db.execute(
-            'SELECT * FROM pchats WHERE id=?', (gid,)).fetchone()
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM pchats WHERE id=?', (gid,)).fetchone()
 
     def get_pchats(self, id: int) -> List[sqlite3.Row]:
-        return self.db.execute(
-            'SELECT * FROM pchats WHERE account=?', (id,)).fetchall()
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM pchats WHERE account=?', (id,)).fetchall()
 
     def get_pchat_by_contact(self, id: int,
                              contact: str) -> Optional[sqlite3.Row]:
         q = 'SELECT * FROM pchats WHERE account=? AND contact=?'
-        return self.db.execute(q, (id, contact.lower())).fetchone()
+        with self.lock:
+            return self.db.execute(q, (id, contact.lower())).fetchone()
+
+    # ==== avatar =====
+
+    def get_avatar(self, url: str) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM avatars WHERE url=?', (url,)).fetchone()
+
+    def set_avatar(self, url: str, file: str, etag: Optional[str],
+                   modified: Optional[str], size: int,
+                   checked: float) -> None:
+        q = 'REPLACE INTO avatars VALUES (?,?,?,?,?,?,?)'
+        with self.lock, self.db:
+            self.db.execute(
+                q, (url, file, etag, modified, size, checked, checked))
+
+    def touch_avatar(self, url: str, used: float) -> None:
+        with self.lock, self.db:
+            self.db.execute(
+                'UPDATE avatars SET used=? WHERE url=?', (used, url))
+
+    def get_avatars(self) -> List[sqlite3.Row]:
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM avatars ORDER BY used DESC').fetchall()
+
+    def remove_avatar(self, url: str) -> None:
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM avatars WHERE url=?', (url,))
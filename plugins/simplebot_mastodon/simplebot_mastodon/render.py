@@ -0,0 +1,48 @@
+from html.parser import HTMLParser
+from typing import Dict, List
+
+
+class _TootParser(HTMLParser):
+    def __init__(self, mentions: Dict[str, str]) -> None:
+        super().__init__(convert_charrefs=True)
+        self.mentions = mentions
+        self.parts: List[str] = []
+        self.in_mention = 0  # depth of <a> tags inside a replaced mention
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if self.in_mention:
+            if tag == 'a':
+                self.in_mention += 1
+        elif tag == 'br':
+            self.parts.append('\n')
+        elif tag == 'a' and self.mentions:
+            attrs = dict(attrs)
+            if 'u-url' in (attrs.get('class') or '').split():
+                name = self.mentions.get(attrs.get('href'))
+                if name:
+                    self.parts.append(name)
+                    self.in_mention = 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if self.in_mention:
+            if tag == 'a':
+                self.in_mention -= 1
+        elif tag == 'p':
+            self.parts.append('\n\n')
+
+    def handle_data(self, data: str) -> None:
+        if not self.in_mention:
+            self.parts.append(data)
+
+
+def toot2text(content: str, mentions: Dict[str, str] = None) -> str:
+    """Convert the HTML content of a toot to plain text in a single pass.
+
+    Links to the mentioned accounts, `mentions` maps their URL to the text
+    to show, are replaced with that text, `<br>` with a line break and
+    paragraphs are followed by an empty line.
+    """
+    parser = _TootParser(mentions or {})
+    parser.feed(content)
+    parser.close()
+    return ''.join(parser.parts)
@@ -0,0 +1,102 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict
+
+from pydub import AudioSegment
+
+
+def _to_mp3(src: str, dst: str) -> str:
+    """Convert the AAC audio file `src` to MP3, runs in a worker process."""
+    tmp = '{}.{}.tmp'.format(dst, os.getpid())
+    AudioSegment.from_file(src, 'aac').export(tmp, format='mp3')
+    os.replace(tmp, dst)
+    return dst
+
+
+class Transcoder:
+    """Convert voice messages to MP3 in a pool of worker processes.
+
+    At most `workers` conversions (ffmpeg processes) run at the same time,
+    the rest wait in the pool's queue. The workers are spawned, not forked,
+    so they don't inherit locks held by the bot's other threads. Converted
+    files are stored under the hash of the original file, so the same audio
+    is converted only once, and the oldest ones are deleted when the cache
+    grows over `max_size` bytes, except those still in use.
+    """
+
+    def __init__(self, path: str, workers: int, max_size: int) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'))
+        self.pending: Dict[str, Future] = {}
+        # converted file -> number of users that didn't release it yet
+        self.in_use: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def to_mp3(self, filename: str) -> Future:
+        """Get a future with the path of the given file converted to MP3.
+
+        The converted file is not evicted until it is passed to `release()`
+        once it was used.
+        """
+        with open(filename, 'rb') as fh:
+            digest = hashlib.sha1(fh.read()).hexdigest()
+        dst = os.path.join(self.path, digest + '.mp3')
+        with self.lock:
+            self.in_use[dst] = self.in_use.get(dst, 0) + 1
+            future = self.pending.get(digest)
+            if future:
+                return future
+            if os.path.exists(dst):
+                os.utime(dst)
+                future = Future()
+                future.set_result(dst)
+                return future
+            future = self.pool.submit(_to_mp3, filename, dst)
+            self.pending[digest] = future
+        future.add_done_callback(lambda f: self._done(digest, dst, f))
+        return future
+
+    def _done(self, digest: str, dst: str, future: Future) -> None:
+        with self.lock:
+            del self.pending[digest]
+            if future.cancelled() or future.exception() is not None:
+                self.in_use.pop(dst, None)  # there is no file to release
+
+    def release(self, dst: str) -> None:
+        """Allow the converted file to be evicted, and evict the oldest
+        files, but never the one that was just used.
+        """
+        with self.lock:
+            count = self.in_use.pop(dst, 1) - 1
+            if count > 0:
+                self.in_use[dst] = count
+        self.evict(keep=dst)
+
+    def evict(self, keep: str = None) -> None:
+        """Delete the oldest converted files over the size limit, except
+        those in use and `keep`.
+        """
+        with self.lock:
+            keep_files = set(self.in_use)
+        keep_files.add(keep)
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.mp3'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = 0
+        for _, fsize, path in sorted(files, reverse=True):
+            size += fsize
+            if size > self.max_size and path not in keep_files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -7,6 +7,7 @@ import shutil
 import zipfile
 import zlib
 from tempfile import NamedTemporaryFile
+from typing import Callable, Tuple
 from urllib.parse import quote, quote_plus, unquote_plus
 
 import bs4
@@ -15,15 +16,22 @@ import simplebot
 from deltachat import Message
 from html2text import html2text
 from readability import Document
+from requests.adapters import HTTPAdapter
 from simplebot import DeltaBot
 from simplebot.bot import Replies
 
+from .webcache import WebCache
+
 __version__ = '1.0.0'
 zlib.Z_DEFAULT_COMPRESSION = 9
 ua = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:60.0) Gecko/20100101'
 ua += ' Firefox/60.0'
 HEADERS = {'user-agent': ua}
 img_providers: list
+cache: WebCache
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=50, pool_maxsize=10))
+session.mount('http://', HTTPAdapter(pool_connections=50, pool_maxsize=10))
 
 
 class FileTooBig(ValueError):
@@ -32,10 +40,15 @@ class FileTooBig(ValueError):
 
 @simplebot.hookimpl
 def deltabot_init(bot: DeltaBot) -> None:
-    global img_providers
+    global img_providers, cache
     img_providers = [_dogpile_imgs, _startpage_imgs, _google_imgs]
 
     _getdefault(bot, 'max_size', 1024*1024*5)
+    path = os.path.join(os.path.dirname(bot.account.db_path), __name__)
+    cache = WebCache(
+        os.path.join(path, 'cache'),
+        int(_getdefault(bot, 'cache_size', 1024*1024*50)),
+        int(_getdefault(bot, 'cache_ttl', 60*5)))
 
 
 @simplebot.filter(name=__name__)
@@ -53,64 +66,64 @@ def filter_messages(bot: DeltaBot, message: Message, replies: Replies) -> None:
         url = url.replace('https://twitter.com', nitter, count=1)
     elif url.startswith('https://mobile.twitter.com/'):
         url = url.replace('https://mobile.twitter.com/', nitter, count=1)
-    with requests.get(url, headers=HEADERS, stream=True) as r:
-        r.raise_for_status()
-        content_type = r.headers.get('content-type', '').lower()
-        if 'text/html' in content_type:
-            soup = bs4.BeautifulSoup(r.text, 'html5lib')
-            for t in soup('script'):
-                t.extract()
-            if soup.title:
-                kwargs['text'] = soup.title.get_text().strip()
-            else:
-                kwargs['text'] = 'Page without title'
-            url = r.url
-            index = url.find('/', 8)
-            if index == -1:
-                root = url
-            else:
-                root = url[:index]
-                url = url.rsplit('/', 1)[0]
-            tags = (
-                ('a', 'href', 'mailto:'),
-                ('img', 'src', 'data:'),
-                ('source', 'src', 'data:'),
-                ('link', 'href', None),
-            )
-            for tag, attr, iprefix in tags:
-                for e in soup(tag, attrs={attr: True}):
-                    if iprefix and e[attr].startswith(iprefix):
-                        continue
-                    e[attr] = re.sub(r'^(//.*)', r'{}:\1'.format(
-                        root.split(':', 1)[0]), e[attr])
-                    e[attr] = re.sub(
-                        r'^(/.*)', r'{}\1'.format(root), e[attr])
-                    if not re.match(r'^https?://', e[attr]):
-                        e[attr] = '{}/{}'.format(url, e[attr])
-            kwargs['html'] = str(soup)
-        elif 'image/' in content_type:
-            kwargs['filename'] = 'image.' + re.search(
-                r'image/(\w+)', content_type).group(1)
-            kwargs['bytefile'] = io.BytesIO(r.content)
-        else:
-            size = r.headers.get('content-size')
-            if not size:
-                _size = 0
-                max_size = 1024*1024*5
-                for chunk in r.iter_content(chunk_size=102400):
-                    _size += len(chunk)
-                    if _size > max_size:
-                        size = '>5MB'
-                        break
-                else:
-                    size = '{:,}'.format(_size)
-            ctype = r.headers.get('content-type', '').split(';')[0] or '-'
-            kwargs['text'] = 'Content Type: {}\nContent Size: {}'.format(
-                ctype, size)
-
+    kwargs.update(_fetch(bot, url, 'preview', _render_preview))
     replies.add(**kwargs)
 
 
+def _render_preview(r) -> Tuple[dict, bytes]:
+    content_type = r.headers.get('content-type', '').lower()
+    if 'text/html' in content_type:
+        soup = bs4.BeautifulSoup(r.text, 'html5lib')
+        for t in soup('script'):
+            t.extract()
+        if soup.title:
+            text = soup.title.get_text().strip()
+        else:
+            text = 'Page without title'
+        url = r.url
+        index = url.find('/', 8)
+        if index == -1:
+            root = url
+        else:
+            root = url[:index]
+            url = url.rsplit('/', 1)[0]
+        tags = (
+            ('a', 'href', 'mailto:'),
+            ('img', 'src', 'data:'),
+            ('source', 'src', 'data:'),
+            ('link', 'href', None),
+        )
+        for tag, attr, iprefix in tags:
+            for e in soup(tag, attrs={attr: True}):
+                if iprefix and e[attr].startswith(iprefix):
+                    continue
+                e[attr] = re.sub(r'^(//.*)', r'{}:\1'.format(
+                    root.split(':', 1)[0]), e[attr])
+                e[attr] = re.sub(
+                    r'^(/.*)', r'{}\1'.format(root), e[attr])
+                if not re.match(r'^https?://', e[attr]):
+                    e[attr] = '{}/{}'.format(url, e[attr])
+        return dict(text=text, html=True), str(soup).encode()
+    if 'image/' in content_type:
+        filename = 'image.' + re.search(
+            r'image/(\w+)', content_type).group(1)
+        return dict(name=filename), r.content
+    size = r.headers.get('content-size')
+    if not size:
+        _size = 0
+        max_size = 1024*1024*5
+        for chunk in r.iter_content(chunk_size=102400):
+            _size += len(chunk)
+            if _size > max_size:
+                size = '>5MB'
+                break
+        else:
+            size = '{:,}'.format(_size)
+    ctype = r.headers.get('content-type', '').split(';')[0] or '-'
+    return dict(text='Content Type: {}\nContent Size: {}'.format(
+        ctype, size)), b''
+
+
 @simplebot.command
 def ddg(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> None:
     """Search in DuckDuckGo."""
@@ -128,7 +141,7 @@ def wt(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> None:
     lang = _get_locale(bot, sender)
     url = "https://{}.m.wiktionary.org/wiki/?search={}".format(
         lang, quote_plus(payload))
-    replies.add(**_download_file(url, _get_mode(bot, sender)))
+    replies.add(**_download_file(bot, url, _get_mode(bot, sender)))
 
 
 @simplebot.command
@@ -207,32 +220,38 @@ def img5(bot: DeltaBot, payload: str, replies: Replies) -> None:
 
 
 @simplebot.command
-def lyrics(payload: str, replies: Replies) -> None:
+def lyrics(bot: DeltaBot, payload: str, replies: Replies) -> None:
     """Get song lyrics.
     """
     base_url = 'https://www.lyrics.com'
     url = "{}/lyrics/{}".format(base_url, quote(payload))
-    with requests.get(url, headers=HEADERS) as r:
-        r.raise_for_status()
-        soup = bs4.BeautifulSoup(r.text, 'html.parser')
+    href = _fetch(bot, url, 'lyrics', _render_lyrics_search).get('text')
+    if href:
+        artist, name = map(unquote_plus, href.split('/')[-2:])
+        lyric = _fetch(bot, base_url + href, 'lyrics',
+                       _render_lyrics).get('text')
+        if lyric:
+            text = '🎵 {} - {}\n\n{}'.format(name, artist, lyric)
+            replies.add(text=text)
+            return
+
+    replies.add(text='No results for: {}'.format(payload))
+
+
+def _render_lyrics_search(r) -> Tuple[dict, bytes]:
+    soup = bs4.BeautifulSoup(r.text, 'html.parser')
     best_matches = soup.find('div', class_='best-matches')
     a = best_matches and best_matches.a
     if not a:
         soup = soup.find('div', class_='sec-lyric')
         a = soup and soup.a
-    if a:
-        artist, name = map(unquote_plus, a['href'].split('/')[-2:])
-        url = base_url + a['href']
-        with requests.get(url, headers=HEADERS) as r:
-            r.raise_for_status()
-            soup = bs4.BeautifulSoup(r.text, 'html.parser')
-            lyric = soup.find(id='lyric-body-text')
-            if lyric:
-                text = '🎵 {} - {}\n\n{}'.format(name, artist, lyric.get_text())
-                replies.add(text=text)
-                return
+    return dict(text=a['href'] if a else None), b''
 
-    replies.add(text='No results for: {}'.format(payload))
+
+def _render_lyrics(r) -> Tuple[dict, bytes]:
+    soup = bs4.BeautifulSoup(r.text, 'html.parser')
+    lyric = soup.find(id='lyric-body-text')
+    return dict(text=lyric.get_text() if lyric else None), b''
 
 
 def _getdefault(bot: DeltaBot, key: str, value=None) -> str:
@@ -259,11 +278,8 @@ def _download_images(bot: DeltaBot, query: str, img_count: int) -> list:
     imgs = _get_images(bot, query)
     results = []
     for img_url in imgs[:img_count]:
-        with requests.get(img_url, headers=HEADERS) as r:
-            r.raise_for_status()
-            filename = 'web' + (get_ext(r) or '.jpg')
-            results.append(
-                dict(filename=filename, bytefile=io.BytesIO(r.content)))
+        results.append(_fetch(bot, img_url, 'image', lambda r: (
+            dict(name='web' + (get_ext(r) or '.jpg')), r.content)))
     return results
 
 
@@ -284,7 +300,7 @@ def _get_images(bot: DeltaBot, query: str) -> list:
 def _google_imgs(query: str) -> list:
     url = 'https://www.google.com/search?tbm=isch&sout=1&q={}'.format(
         quote_plus(query))
-    with requests.get(url) as r:
+    with session.get(url) as r:
         r.raise_for_status()
         soup = bs4.BeautifulSoup(r.text, 'html.parser')
     imgs = []
@@ -297,7 +313,7 @@ def _google_imgs(query: str) -> list:
 def _startpage_imgs(query: str) -> list:
     url = 'https://startpage.com/do/search'
     url += '?cat=pics&cmd=process_search&query=' + quote_plus(query)
-    with requests.get(url, headers=HEADERS) as r:
+    with session.get(url, headers=HEADERS) as r:
         r.raise_for_status()
         soup = bs4.BeautifulSoup(r.text, 'html.parser')
         url = r.url
@@ -327,7 +343,7 @@ def _startpage_imgs(query: str) -> list:
 def _dogpile_imgs(query: str) -> list:
     url = 'https://www.dogpile.com/search/images?q={}'.format(
         quote_plus(query))
-    with requests.get(url, headers=HEADERS) as r:
+    with session.get(url, headers=HEADERS) as r:
         r.raise_for_status()
         soup = bs4.BeautifulSoup(r.text, 'html.parser')
     soup = soup.find('div', class_='mainline-results')
@@ -465,38 +481,72 @@ def save_file(bot, data, ext: str) -> str:
     return path
 
 
-def save_htmlzip(bot, html) -> str:
-    with NamedTemporaryFile(dir=bot.account.get_blobdir(), prefix='web-', suffix='.html.zip', delete=False) as file:
-        path = file.name
-    with open(path, 'wb') as f:
-        with zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_DEFLATED) as fzip:
-            fzip.writestr('index.html', html)
-    return path
+def htmlzip(html: str) -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', compression=zipfile.ZIP_DEFLATED) as fzip:
+        fzip.writestr('index.html', html)
+    return data.getvalue()
+
+
+def _fetch(bot: DeltaBot, url: str, mode: str,
+           render: Callable[[requests.Response], Tuple[dict, bytes]]) -> dict:
+    """Get the reply for the given URL and mode.
+    """
+    entry = cache.get(url, mode)
+    if entry and entry.is_fresh():
+        return _unpack(bot, entry.meta, entry.read())
+
+    headers = dict(HEADERS, **entry.validators()) if entry else HEADERS
+    with session.get(url, headers=headers, stream=True) as r:
+        if entry and r.status_code == 304:
+            cache.refresh(entry, r.headers)
+            return _unpack(bot, entry.meta, entry.read())
+        r.raise_for_status()
+        # meta has the reply `text` and either `html`, `file` (extension of
+        # the file to save data in) or `name` (file name to send data as)
+        meta, data = render(r)
+    cache.put(url, mode, r.headers, meta, data)
+    return _unpack(bot, meta, data)
+
+
+def _unpack(bot: DeltaBot, meta: dict, data: bytes) -> dict:
+    reply = {}
+    if meta.get('text') is not None:
+        reply['text'] = meta['text']
+    if meta.get('html'):
+        reply['html'] = data.decode()
+    elif meta.get('file') is not None:
+        reply['filename'] = save_file(bot, data, meta['file'])
+    elif meta.get('name'):
+        reply['filename'] = meta['name']
+        reply['bytefile'] = io.BytesIO(data)
+    return reply
 
 
 def _download_file(bot: DeltaBot, url: str, mode: str = 'htmlzip',
                    readability: bool = False) -> dict:
     if '://' not in url:
         url = 'http://'+url
-    with requests.get(url, headers=HEADERS, stream=True) as r:
-        r.raise_for_status()
-        r.encoding = 'utf-8'
-        bot.logger.debug(
-            'Content type: {}'.format(r.headers['content-type']))
-        if 'text/html' in r.headers['content-type']:
-            if mode == 'text':
-                html = html2read(r.text) if readability else r.text
-                return dict(text=html2text(html))
-            html = _process_html(bot, r)
-            if readability:
-                html = html2read(html)
-            if mode == 'md':
-                return dict(text=r.url,
-                            filename=save_file(bot, html2text(html), '.md'))
-            if mode == 'html':
-                return dict(text=r.url,
-                            filename=save_file(bot, html, '.html'))
-            return dict(text=r.url, filename=save_htmlzip(bot, html))
-        data, ext = _process_file(bot, r)
-        return dict(text=r.url, filename='web'+(ext or ''),
-                    bytefile=io.BytesIO(data))
+    return _fetch(bot, url, mode + ('-read' if readability else ''),
+                  lambda r: _render_file(bot, r, mode, readability))
+
+
+def _render_file(bot: DeltaBot, r, mode: str,
+                 readability: bool) -> Tuple[dict, bytes]:
+    r.encoding = 'utf-8'
+    bot.logger.debug(
+        'Content type: {}'.format(r.headers['content-type']))
+    if 'text/html' in r.headers['content-type']:
+        if mode == 'text':
+            html = html2read(r.text) if readability else r.text
+            return dict(text=html2text(html)), b''
+        html = _process_html(bot, r)
+        if readability:
+            html = html2read(html)
+        if mode == 'md':
+            return dict(text=r.url, file='.md'), html2text(html).encode()
+        if mode == 'html':
+            return dict(text=r.url, file='.html'), html.encode()
+        return dict(text=r.url, file='.html.zip'), htmlzip(html)
+    data, ext = _process_file(bot, r)
+    return dict(text=r.url, name='web'+(ext or '')), data
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str) -> str:
+    """Normalize the URL so equivalent URLs share the same cache entry:
+    lowercase scheme and host, no default port, no fragment and sorted
+    query parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':{}'.format(parts.port)
+    if parts.username:
+        netloc = '{}@{}'.format(parts.username, netloc)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def expiration(headers, default_ttl: float) -> Optional[float]:
+    """Get until when a response is fresh according to its Cache-Control,
+    Expires and Last-Modified headers, or None if it must not be stored.
+
+    Responses marked `private` are stored: the bot doesn't send any
+    credentials, so they aren't specific to the user asking for them.
+    Responses without explicit freshness information are considered fresh
+    for 10% of the time since they were last modified, up to a day, or for
+    `default_ttl` seconds if that is unknown.
+    """
+    now = time.time()
+    directives = {}
+    for directive in (headers.get('cache-control') or '').lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name] = value.strip('"')
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return now
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return now + max(int(directives[name]), 0)
+            except ValueError:
+                return now
+    date = _http_date(headers.get('date')) or now
+    if 'expires' in headers:
+        expires = _http_date(headers.get('expires'))
+        return now + (expires - date) if expires else now
+    modified = _http_date(headers.get('last-modified'))
+    if modified:
+        return now + min(max(date - modified, 0) / 10, 60*60*24)
+    return now + default_ttl
+
+
+class CacheEntry:
+    def __init__(self, path: str, meta: dict) -> None:
+        self.path = path
+        self.meta = meta
+
+    def is_fresh(self) -> bool:
+        return self.meta['expires'] > time.time()
+
+    def validators(self) -> dict:
+        """Headers to revalidate the entry with a conditional request."""
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('modified'):
+            headers['If-Modified-Since'] = self.meta['modified']
+        return headers
+
+    def read(self) -> bytes:
+        with open(self.path + '.data', 'rb') as fh:
+            return fh.read()
+
+
+class WebCache:
+    """On-disk HTTP cache.
+
+    Entries are keyed by normalized URL and a `mode`, the same page can be
+    stored in several forms, ex. the processed HTML and its plain text
+    version, and hold some metadata (a JSON-serializable dict) and data. They
+    are served while fresh and revalidated with ETag/Last-Modified after
+    that, and the least recently used ones are deleted when the cache grows
+    over `max_size` bytes.
+    """
+
+    def __init__(self, path: str, max_size: int,
+                 default_ttl: float = 300) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _path(self, url: str, mode: str) -> str:
+        key = '{} {}'.format(mode, normalize_url(url))
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, url: str, mode: str) -> Optional[CacheEntry]:
+        path = self._path(url, mode)
+        try:
+            with open(path + '.json') as fh:
+                meta = json.load(fh)
+            os.utime(path + '.json')
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(path + '.data'):
+            return None
+        return CacheEntry(path, meta)
+
+    def put(self, url: str, mode: str, headers, meta: dict,
+            data: bytes) -> None:
+        """Store the response unless its headers forbid it or it can never
+        be served from the cache.
+        """
+        expires = expiration(headers, self.default_ttl)
+        if expires is None:
+            return
+        meta = dict(meta, expires=expires, etag=headers.get('etag'),
+                    modified=headers.get('last-modified'))
+        if expires <= time.time() and not (meta['etag'] or meta['modified']):
+            return
+        path = self._path(url, mode)
+        self._write(path + '.data', data)
+        self._write(path + '.json', json.dumps(meta).encode())
+        self.evict()
+
+    def refresh(self, entry: CacheEntry, headers) -> None:
+        """Update the entry after it was revalidated (304 Not Modified)."""
+        expires = expiration(headers, self.default_ttl)
+        if expires is None:
+            self.remove(entry.path)
+            return
+        entry.meta['expires'] = expires
+        entry.meta['etag'] = headers.get('etag') or entry.meta['etag']
+        entry.meta['modified'] = headers.get(
+            'last-modified') or entry.meta['modified']
+        self._write(entry.path + '.json', json.dumps(entry.meta).encode())
+
+    def remove(self, path: str) -> None:
+        for ext in ('.json', '.data'):
+            try:
+                os.remove(path + ext)
+            except OSError:
+                pass
+
+    def evict(self) -> None:
+        """Delete the least recently used entries over the size limit."""
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if not entry.name.endswith('.json'):
+                    continue
+                path = entry.path[:-5]
+                try:
+                    stat = entry.stat()
+                    size = stat.st_size + os.path.getsize(path + '.data')
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, size, path))
+            total = 0
+            for _, size, path in sorted(entries, reverse=True):
+                total += size
+                if total > self.max_size:
+                    self.remove(path)
+
+    def _write(self, path: str, data: bytes) -> None:
+        tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp, path)